@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch Writes.
+
+Validate and apply a batch of book or library changes in one
+transaction. A batch is a JSON object with optional "create", "update"
+and "delete" lists; every item gets a result entry, and the batch is
+applied only when every item is valid.
+
+The ownership rules are the ones the form views use: only the owner
+of a library may add books to it, change it or delete it, and only the
+owner of a book may change or delete it.
+"""
+from flask import current_app
+
+import bulkdelete
+import reference
+from librarydb_setup import Book, Library
+from versions import book_keys, library_keys
+
+MAX_BATCH_ITEMS = 5000
+
+BOOK_FIELDS = {'title': 80, 'author': 80, 'description': 250}
+# Book fields that may be left out of an update, but not emptied.
+BOOK_NOT_NULL = ('title',)
+LIBRARY_FIELDS = {'name': 250}
+
+
+class BatchError(Exception):
+    """The batch as a whole is malformed."""
+
+
+def batch_items(payload):
+    """Return the create, update and delete lists of a batch payload."""
+    if not isinstance(payload, dict):
+        raise BatchError('The batch must be a JSON object.')
+    lists = [payload.get(op) or [] for op in ('create', 'update', 'delete')]
+    if not all(isinstance(items, list) for items in lists):
+        raise BatchError('create, update and delete must be lists.')
+    if sum(len(items) for items in lists) > MAX_BATCH_ITEMS:
+        raise BatchError('A batch holds at most %d items.' % MAX_BATCH_ITEMS)
+    return lists
+
+
+def check_text(item, fields, required, errors):
+    """Check the text fields of an item against their maximum length."""
+    for field, length in fields.items():
+        value = item.get(field)
+        if value is None:
+            if field in required:
+                errors.append('%s is required.' % field)
+        elif not isinstance(value, str) or (field in required and
+                                            not value.strip()):
+            errors.append('%s must be a non-empty string.' % field)
+        elif len(value) > length:
+            errors.append('%s is longer than %d characters.'
+                          % (field, length))
+
+
+def result(op, index, errors, row_id=None):
+    """Return the result entry of one batch item."""
+    return {'op': op, 'index': index, 'id': row_id, 'ok': not errors,
+            'errors': errors}
+
+
+def is_id(value):
+    """Return True if `value` can be a row id: an int, but not a bool."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def repeated_ids(ids):
+    """Return the ids that appear more than once in a list of `ids`."""
+    seen = set()
+    repeated = set()
+    for row_id in ids:
+        if is_id(row_id):
+            (repeated if row_id in seen else seen).add(row_id)
+    return repeated
+
+
+def load_rows(session, model, ids):
+    """Return {id: row} for the rows of `model` with `ids`."""
+    ids = [i for i in ids if is_id(i)]
+    if not ids:
+        return {}
+    return dict((row.id, row) for row in
+                session.query(model).filter(model.id.in_(ids)))
+
+
+def apply_books(session, user_id, payload):
+    """
+    Validate and stage a batch of book changes.
+
+    Returns (results, keys): one result per item and the resource keys
+    the changes touch. Nothing is staged unless every item is valid;
+    the caller commits or rolls back.
+    """
+    creates, updates, deletes = batch_items(payload)
+    library_ids = [item.get('library_id') for item in creates + updates
+                   if isinstance(item, dict)]
+    libraries = load_rows(session, Library, library_ids)
+    update_ids = [item.get('id') for item in updates
+                  if isinstance(item, dict)]
+    books = load_rows(session, Book, update_ids + deletes)
+
+    def check_book(item, required):
+        errors = []
+        if not isinstance(item, dict):
+            return ['Each item must be a JSON object.']
+        required = tuple(required) + tuple(
+            field for field in BOOK_NOT_NULL if field in item)
+        check_text(item, BOOK_FIELDS, required, errors)
+        if 'genre_id' in item or 'genre_id' in required:
+            if not is_id(item.get('genre_id')):
+                errors.append('genre_id must be an integer.')
+            elif reference.genres.get(item['genre_id']) is None:
+                errors.append('genre_id does not exist.')
+        if 'library_id' in item or 'library_id' in required:
+            library_id = item.get('library_id')
+            if not is_id(library_id):
+                errors.append('library_id must be an integer.')
+            elif library_id not in libraries:
+                errors.append('library_id does not exist.')
+            elif libraries[library_id].user_id != user_id:
+                errors.append('You are not authorized to add books to '
+                              'this Library.')
+        return errors
+
+    def check_owner(book_id, repeated):
+        if not is_id(book_id):
+            return None, ['Book ids must be integers.']
+        if book_id in repeated:
+            return None, ['Book %s appears more than once.' % book_id]
+        book = books.get(book_id)
+        if book is None:
+            return None, ['Book %s does not exist.' % book_id]
+        if book.user_id != user_id:
+            return None, ['You are not authorized to Edit this book.']
+        return book, []
+
+    results = []
+    staged = []
+    for index, item in enumerate(creates):
+        errors = check_book(item, ('title', 'genre_id', 'library_id'))
+        results.append(result('create', index, errors))
+        if not errors:
+            staged.append(('create', index, item))
+    repeated = repeated_ids(update_ids)
+    for index, item in enumerate(updates):
+        book, errors = check_owner(item.get('id') if isinstance(
+            item, dict) else None, repeated)
+        errors += check_book(item, ())
+        results.append(result('update', index, errors,
+                              book.id if book else None))
+        if not errors:
+            staged.append(('update', index, (book, item)))
+    repeated = repeated_ids(deletes)
+    for index, book_id in enumerate(deletes):
+        book, errors = check_owner(book_id, repeated)
+        results.append(result('delete', index, errors, book_id))
+        if not errors:
+            staged.append(('delete', index, book))
+    if not all(r['ok'] for r in results):
+        return results, []
+
+    keys = []
+    created = []
+    for op, index, value in staged:
+        if op == 'create':
+            book = Book(user_id=user_id, **dict(
+                (field, value.get(field)) for field in
+                ('title', 'author', 'description', 'genre_id', 'library_id')))
+            session.add(book)
+            created.append((index, book))
+        elif op == 'update':
+            book, item = value
+            keys += book_keys(book)
+            for field in ('title', 'author', 'description', 'genre_id',
+                          'library_id'):
+                if field in item:
+                    setattr(book, field, item[field])
+            keys += book_keys(book)
+        else:
+            keys += book_keys(value)
+            session.delete(value)
+    session.flush()
+    for index, book in created:
+        results[index]['id'] = book.id
+        keys += book_keys(book)
+    return results, keys
+
+
+def apply_libraries(session, user_id, payload):
+    """
+    Validate and stage a batch of library changes.
+
+    Returns (results, keys) like apply_books().
+    """
+    creates, updates, deletes = batch_items(payload)
+    update_ids = [item.get('id') for item in updates
+                  if isinstance(item, dict)]
+    libraries = load_rows(session, Library, update_ids + deletes)
+
+    def check_owner(library_id, action, repeated):
+        if not is_id(library_id):
+            return None, ['Library ids must be integers.']
+        if library_id in repeated:
+            return None, ['Library %s appears more than once.' % library_id]
+        library = libraries.get(library_id)
+        if library is None:
+            return None, ['Library %s does not exist.' % library_id]
+        if library.user_id != user_id:
+            return None, ['You are not authorized to %s this Library.'
+                          % action]
+        return library, []
+
+    results = []
+    staged = []
+    for index, item in enumerate(creates):
+        errors = []
+        if not isinstance(item, dict):
+            errors.append('Each item must be a JSON object.')
+        else:
+            check_text(item, LIBRARY_FIELDS, ('name',), errors)
+        results.append(result('create', index, errors))
+        if not errors:
+            staged.append(('create', index, item))
+    repeated = repeated_ids(update_ids)
+    for index, item in enumerate(updates):
+        library, errors = check_owner(item.get('id') if isinstance(
+            item, dict) else None, 'edit', repeated)
+        if not errors:
+            check_text(item, LIBRARY_FIELDS, ('name',), errors)
+        results.append(result('update', index, errors,
+                              library.id if library else None))
+        if not errors:
+            staged.append(('update', index, (library, item)))
+    repeated = repeated_ids(deletes)
+    # Large libraries are deleted by a background job, outside of any
+    # batch transaction.
+    threshold = current_app.config['LARGE_DELETE_THRESHOLD']
+    for index, library_id in enumerate(deletes):
+        library, errors = check_owner(library_id, 'delete', repeated)
+        if library is not None and library.book_count > threshold:
+            errors.append('Library %s has too many books to delete in a '
+                          'batch; delete it on its own.' % library_id)
+        results.append(result('delete', index, errors, library_id))
+        if not errors:
+            staged.append(('delete', index, library))
+    if not all(r['ok'] for r in results):
+        return results, []
+
+    keys = []
+    created = []
+    for op, index, value in staged:
+        if op == 'create':
+            library = Library(name=value['name'], user_id=user_id)
+            session.add(library)
+            created.append((index, library))
+        elif op == 'update':
+            library, item = value
+            library.name = item['name']
+            keys += library_keys(library)
+        else:
+            # Touches the library, its genres and the latest books.
+            bulkdelete.delete_books(value.id)
+    session.flush()
+    for index, library in created:
+        results[index]['id'] = library.id
+        keys += library_keys(library)
+    return results, keys
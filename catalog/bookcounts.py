@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Book Counts.
+
+Library.book_count and Genre.book_count follow every book the ORM
+adds, moves or deletes (see librarydb_setup.py), and the bulk loader
+and bulk deletes adjust them themselves. Should they drift anyway,
+e.g. after rows were changed by hand, this recounts them.
+
+    python bookcounts.py           # repair the counts
+    python bookcounts.py --check   # only report the drift
+"""
+import argparse
+
+from sqlalchemy import func, select
+
+from librarydb_setup import Book, Genre, Library, record_selected_changes
+
+FOREIGN_KEYS = ((Library, Book.__table__.c.library_id),
+                (Genre, Book.__table__.c.genre_id))
+
+
+def actual_count(model, column):
+    """Return the correlated COUNT(*) of the books of a `model` row."""
+    return select(func.count()).where(
+        column == model.__table__.c.id).scalar_subquery()
+
+
+def drift(bind, model, column):
+    """Return how many `model` rows have a wrong book_count."""
+    table = model.__table__
+    return bind.execute(select(func.count()).where(
+        table.c.book_count != actual_count(model, column))).scalar()
+
+
+def recount(bind, model, column, ids=None):
+    """Fix the book_count of `model` rows, all or `ids`; return the fixes."""
+    table = model.__table__
+    count = actual_count(model, column)
+    wrong = [table.c.book_count != count]
+    if ids is not None:
+        wrong.append(table.c.id.in_(list(ids)))
+    if model is Library:
+        # The count is part of what the change feed sends.
+        record_selected_changes(bind, 'library', select(table.c.id).where(
+            *wrong))
+    return bind.execute(table.update().where(*wrong).values(
+        book_count=count)).rowcount
+
+
+def reconcile(bind, check=False):
+    """Recount every library and genre; return {table: rows wrong}."""
+    found = {}
+    for model, column in FOREIGN_KEYS:
+        if check:
+            found[model.__tablename__] = drift(bind, model, column)
+        else:
+            found[model.__tablename__] = recount(bind, model, column)
+    return found
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Repair the book counts of libraries and genres.')
+    parser.add_argument('--check', action='store_true',
+                        help='report the wrong counts without fixing them')
+    args = parser.parse_args()
+
+    import versions
+    from database import session
+    found = reconcile(session, args.check)
+    for table, rows in sorted(found.items()):
+        print("%s: %d wrong book counts%s"
+              % (table, rows, '' if args.check else ' fixed'))
+    if not args.check and any(found.values()):
+        # The pages that show counts depend on these keys.
+        versions.touch(session, 'books', 'libraries')
+    session.commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk Library Deletes.
+
+Deleting a library with many books in one statement can hold locks
+for a long time, so large libraries are deleted by a background job
+(see jobs.py): books go in batches of BATCH_SIZE, each in its own
+short transaction, then the library itself. Progress can be followed
+with progress().
+"""
+from sqlalchemy import func, select
+from sqlalchemy.orm.exc import NoResultFound
+
+import bookcounts
+import jobs
+import versions
+from database import session
+from librarydb_setup import Book, Genre, Library, count_books
+from librarydb_setup import record_changes, record_selected_changes
+from versions import library_keys
+
+BATCH_SIZE = 5000
+JOB = 'delete_library'
+
+
+def delete_books(library_id):
+    """
+    Delete a library's books and the library in one transaction.
+
+    This is a single DELETE statement however many books there are; the
+    caller commits.
+    """
+    library = session.query(Library).filter_by(id=library_id).one()
+    genre_counts = dict(session.query(Book.genre_id, func.count()).filter_by(
+        library_id=library_id).group_by(Book.genre_id))
+    record_selected_changes(session, 'book', select(Book.id).where(
+        Book.library_id == library_id), 'delete')
+    session.query(Book).filter_by(library_id=library_id).delete(
+        synchronize_session=False)
+    count_books(session, Genre, dict((genre_id, -count) for genre_id, count
+                                     in genre_counts.items()))
+    versions.touch(session, 'books', *library_keys(library))
+    versions.touch(session, *['genre:%s' % i for i in genre_counts])
+    session.delete(library)
+
+
+@jobs.handler(JOB)
+def run(library_id, total, batch_size=BATCH_SIZE):
+    """Delete a library batch by batch, recording progress as it goes."""
+    if session.query(Library.id).filter_by(id=library_id).first() is None:
+        # An earlier attempt got as far as deleting the library.
+        return
+    genre_ids = [row.genre_id for row in session.query(
+        Book.genre_id).filter_by(library_id=library_id).distinct()]
+    session.commit()
+    deleted = 0
+    while True:
+        ids = [row.id for row in session.query(Book.id).filter_by(
+            library_id=library_id).limit(batch_size)]
+        if ids:
+            record_changes(session, 'book', ids, 'delete')
+            session.query(Book).filter(Book.id.in_(ids)).delete(
+                synchronize_session=False)
+        session.commit()
+        deleted += len(ids)
+        jobs.report(total=total, deleted=deleted)
+        if len(ids) < batch_size:
+            break
+    # Whatever is left (rows added meanwhile) goes with the library.
+    try:
+        delete_books(library_id)
+    except NoResultFound:
+        # Deleted meanwhile by its owner; the recount still applies.
+        session.rollback()
+    # The batches above did not count the genres' lost books.
+    bookcounts.recount(session, Genre, Book.__table__.c.genre_id, genre_ids)
+    versions.touch(session, *['genre:%s' % i for i in genre_ids])
+    session.commit()
+
+
+def start(library_id, total):
+    """Queue the delete of a library; False if one is already queued."""
+    return jobs.enqueue(JOB, library_id, total,
+                        key=str(library_id)) is not None
+
+
+def progress(library_id):
+    """Return the progress of a background delete, or None."""
+    job = jobs.queue.find(JOB, str(library_id))
+    if job is None:
+        return None
+    status = {'library_id': library_id, 'total': job['args'][1],
+              'deleted': 0, 'state': job['state'],
+              'attempts': job['attempts']}
+    status.update(job['progress'] or {})
+    if job['error'] is not None:
+        status['error'] = job['error']
+    return status
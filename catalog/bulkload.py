@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk Book Loader.
+
+Streams book records from a CSV or NDJSON file into the database in
+batches, using COPY on Postgres and executemany elsewhere. Each record
+has a title, author, description, genre (name) and library (name);
+names are resolved through in-memory maps, so loading costs no lookups
+per row. Memory use is bounded by the batch size.
+
+    python bulkload.py books.csv --owner-email me@example.com
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import sys
+import time
+
+from sqlalchemy import func, select
+
+import reference
+import versions
+from database import engine, session
+from librarydb_setup import Book, Genre, Library, User, count_books
+from librarydb_setup import record_selected_changes
+
+BATCH_SIZE = 5000
+COLUMNS = ('title', 'author', 'description', 'genre_id', 'library_id',
+           'user_id')
+
+
+def read_records(path, fmt):
+    """Yield the records of a CSV or NDJSON file one at a time."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class NameMap(object):
+    """Map names to row ids, creating missing rows when allowed."""
+
+    def __init__(self, model, create=None):
+        self.model = model
+        self.create = create
+        self.ids = dict((row.name, row.id) for row in
+                        session.query(model.id, model.name))
+
+    def __call__(self, name):
+        if name not in self.ids and self.create is not None:
+            row = self.create(name)
+            session.add(row)
+            session.commit()
+            self.ids[name] = row.id
+        return self.ids.get(name)
+
+
+def record_name(record, field):
+    """Return the stripped name in `field` of a record, or ''."""
+    name = record.get(field)
+    return name.strip() if isinstance(name, str) else ''
+
+
+def prepare(records, genres, libraries, owner_id, rejected):
+    """
+    Turn records into book rows, skipping the invalid ones.
+
+    `rejected` counts the skipped records and keeps the first few
+    record numbers as examples. Names are only looked up, and missing
+    rows only created, for records with a title, genre and library.
+    """
+    for number, record in enumerate(records, 1):
+        title = (record.get('title') or '').strip()
+        genre = record_name(record, 'genre')
+        library = record_name(record, 'library')
+        genre_id = library_id = None
+        if title and genre and library:
+            genre_id = genres(genre)
+            library_id = libraries(library)
+        if genre_id is None or library_id is None:
+            rejected['count'] += 1
+            if len(rejected['examples']) < 10:
+                rejected['examples'].append(number)
+            continue
+        yield {'title': title[:80],
+               'author': (record.get('author') or '')[:80],
+               'description': (record.get('description') or '')[:250],
+               'genre_id': genre_id,
+               'library_id': library_id,
+               'user_id': owner_id}
+
+
+def copy_batch(rows):
+    """Load one batch with Postgres COPY."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([row[c] for c in COLUMNS])
+    buf.seek(0)
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.copy_expert('COPY book (%s) FROM STDIN WITH (FORMAT csv)'
+                           % ', '.join(COLUMNS), buf)
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def insert_batch(rows):
+    """Load one batch with a single executemany INSERT."""
+    with engine.begin() as conn:
+        conn.execute(Book.__table__.insert(), rows)
+
+
+def load(path, fmt, owner_email, create_missing=False,
+         batch_size=BATCH_SIZE):
+    """Load a file of books; return (loaded, rejected records)."""
+    owner = session.query(User).filter_by(email=owner_email).one()
+    genres = NameMap(Genre)
+    libraries = NameMap(Library)
+    if create_missing:
+        genres.create = lambda name: Genre(name=name)
+        libraries.create = lambda name: Library(name=name, user_id=owner.id)
+    # Books above this id are new, for the change feed.
+    last_id = session.query(func.max(Book.id)).scalar() or 0
+    # Do not keep a read transaction open for the whole load.
+    session.commit()
+    if engine.dialect.name == 'postgresql':
+        write = copy_batch
+    else:
+        write = insert_batch
+
+    rejected = {'count': 0, 'examples': []}
+    rows = prepare(read_records(path, fmt), genres, libraries, owner.id,
+                   rejected)
+    touched = set(['books', 'libraries'])
+    library_counts = {}
+    genre_counts = {}
+    loaded = 0
+    started = time.time()
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        write(batch)
+        loaded += len(batch)
+        for row in batch:
+            touched.add('library:%s' % row['library_id'])
+            touched.add('genre:%s' % row['genre_id'])
+            library_counts[row['library_id']] = library_counts.get(
+                row['library_id'], 0) + 1
+            genre_counts[row['genre_id']] = genre_counts.get(
+                row['genre_id'], 0) + 1
+        elapsed = time.time() - started
+        print("%d books loaded, %d rows/sec" % (loaded, loaded / elapsed))
+
+    # A load that fails halfway leaves the counts short of the batches
+    # already written, and them out of the change feed; bookcounts.py
+    # repairs the counts.
+    record_selected_changes(session, 'book', select(Book.id).where(
+        Book.id > last_id))
+    count_books(session, Library, library_counts)
+    count_books(session, Genre, genre_counts)
+    versions.touch(session, *touched)
+    session.commit()
+    reference.genres.invalidate()
+    return loaded, rejected
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Load books from a CSV or NDJSON file.')
+    parser.add_argument('path', help='file of book records')
+    parser.add_argument('--format', choices=['csv', 'ndjson'],
+                        help='file format, guessed from the extension')
+    parser.add_argument('--owner-email', required=True,
+                        help='email of the user who owns the new books')
+    parser.add_argument('--create-missing', action='store_true',
+                        help='create genres and libraries that do not exist')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    fmt = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+    started = time.time()
+    loaded, rejected = load(args.path, fmt, args.owner_email,
+                            args.create_missing, args.batch_size)
+    elapsed = time.time() - started
+    print("Loaded %d books in %.1fs (%d rows/sec)"
+          % (loaded, elapsed, loaded / elapsed if elapsed else loaded))
+    if rejected['count']:
+        print("Skipped %d invalid records, e.g. record %s"
+              % (rejected['count'],
+                 ', '.join(map(str, rejected['examples']))),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Change Feed.
+
+Every library and book saved or deleted gets an entry in the
+change_log table, in the same transaction as the change (see
+librarydb_setup.py), numbered by an ever-growing sequence number.
+/changes/JSON?since=<seq> sends the entries after `seq`, oldest first,
+with the current JSON of each saved object. A mirror of the catalog
+applies them and asks again with the last seq it got, so a poll costs
+what changed rather than the whole catalog. since=0 sends everything.
+
+Compaction, `python changes.py --compact` from cron:
+- an entry followed by a newer one for the same object is dropped, as
+  the newer one tells a mirror all it needs;
+- delete entries older than RETENTION_DAYS are dropped,
+  and the highest seq dropped becomes the floor. A mirror that last
+  synced below the floor may have missed a delete: it gets 410 Gone and
+  must start over from since=0.
+"""
+import argparse
+import datetime
+
+from sqlalchemy import func, select
+
+from librarydb_setup import Book, Change, Library, ResourceVersion
+from serialization import BOOK_FIELDS, LIBRARY_FIELDS, Projection
+
+# The floor is kept as the version of this resource_version row.
+FLOOR_KEY = 'change-log:floor'
+# Days delete entries are kept: how long a mirror may go without a sync.
+RETENTION_DAYS = 7
+
+# The objects sent with saved entries; books also carry their library.
+PROJECTIONS = {
+    'library': Projection(Library.id, LIBRARY_FIELDS,
+                          joins={'user': Library.user}),
+    'book': Projection(Book.id, BOOK_FIELDS + [
+        ('library_id', Book.library_id, None)]),
+}
+
+
+def floor(session):
+    """Return the floor: mirrors must have synced at least this far."""
+    return session.query(ResourceVersion.version).filter_by(
+        key=FLOOR_KEY).scalar() or 0
+
+
+def raise_floor(session, seq):
+    """Raise the floor to `seq` unless it is already higher."""
+    if seq <= floor(session):
+        return
+    if not session.query(ResourceVersion).filter_by(key=FLOOR_KEY).update(
+            {ResourceVersion.version: seq,
+             ResourceVersion.updated_at: datetime.datetime.utcnow()},
+            synchronize_session=False):
+        session.add(ResourceVersion(key=FLOOR_KEY, version=seq))
+
+
+def page(session, since, limit, settle=0):
+    """
+    Return the changes after `since`, the last seq read and whether more
+    follow.
+
+    The page stops at the first entry younger than `settle` seconds: on
+    Postgres a transaction may commit after a later one, and its entries
+    would land behind a mirror that already read past them. Later
+    entries are not sent either, even older looking ones, as created_at
+    comes from the clock of the process that wrote the entry.
+    """
+    entries = session.query(Change).filter(Change.seq > since).order_by(
+        Change.seq).limit(limit + 1).all()
+    more = len(entries) > limit
+    entries = entries[:limit]
+    if settle:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=settle)
+        for i, entry in enumerate(entries):
+            if entry.created_at > cutoff:
+                entries, more = entries[:i], False
+                break
+
+    # Only the latest entry of an object in the page is sent.
+    latest = dict(((e.kind, e.object_id), e) for e in entries)
+    objects = {}
+    for kind, projection in PROJECTIONS.items():
+        ids = [object_id for (k, object_id), e in latest.items()
+               if k == kind and e.op == 'upsert']
+        if ids:
+            query, serialize = projection.select(session, projection.names)
+            for row in query.filter(projection.key.in_(ids)):
+                objects[(kind, row.id)] = serialize(row)
+
+    changes = []
+    for entry in entries:
+        key = (entry.kind, entry.object_id)
+        if latest[key] is not entry:
+            continue
+        change = {'seq': entry.seq, 'kind': entry.kind,
+                  'id': entry.object_id, 'op': entry.op}
+        if entry.op == 'upsert':
+            if key not in objects:
+                # Deleted since; its delete entry comes later.
+                continue
+            change['object'] = objects[key]
+        changes.append(change)
+    last = entries[-1].seq if entries else since
+    return changes, last, more
+
+
+def compact(session, retention_days=RETENTION_DAYS):
+    """Drop superseded and expired entries; return what was dropped."""
+    table = Change.__table__
+    newer = table.alias('newer')
+    superseded = session.execute(table.delete().where(
+        table.c.seq < select(func.max(newer.c.seq)).where(
+            newer.c.kind == table.c.kind,
+            newer.c.object_id == table.c.object_id).scalar_subquery())
+    ).rowcount
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        days=retention_days)
+    expired = table.c.op == 'delete', table.c.created_at < cutoff
+    highest = session.execute(
+        select(func.max(table.c.seq)).where(*expired)).scalar()
+    deletes = 0
+    if highest is not None:
+        deletes = session.execute(table.delete().where(
+            table.c.seq <= highest, *expired)).rowcount
+        raise_floor(session, highest)
+    return {'superseded': superseded, 'deletes': deletes,
+            'floor': floor(session)}
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Compact the catalog change feed.')
+    parser.add_argument('--compact', action='store_true',
+                        help='drop superseded and expired entries')
+    parser.add_argument('--retention-days', type=float,
+                        default=RETENTION_DAYS,
+                        help='age at which delete entries are dropped')
+    args = parser.parse_args()
+
+    from database import session
+    if args.compact:
+        dropped = compact(session, args.retention_days)
+        session.commit()
+        print("Dropped %(superseded)d superseded and %(deletes)d expired "
+              "delete entries, floor at %(floor)d" % dropped)
+    count, last = session.query(func.count(), func.max(Change.seq)).one()
+    print("%d entries, last seq %s, floor %d"
+          % (count, last or 0, floor(session)))
+
+
+if __name__ == '__main__':
+    main()
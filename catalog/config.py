@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Application Configuration.
+
+Everything the app needs from files or the environment is read and
+checked once, at startup, by load_config(). The OAuth provider
+settings end up in app.config as immutable named tuples, so request
+handlers never open or parse a file.
+
+Settings are read in this order, later ones winning:
+1. the defaults below,
+2. a Flask config file named by the CATALOG_SETTINGS variable,
+3. CATALOG_* environment variables.
+"""
+import json
+import os
+import stat
+from collections import namedtuple
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+# Files the app writes for itself, readable only by the app's user.
+INSTANCE_FOLDER = os.path.join(THIS_FOLDER, 'instance')
+
+GoogleSettings = namedtuple('GoogleSettings', [
+    'client_id', 'client_secret', 'auth_uri', 'token_uri'])
+FacebookSettings = namedtuple('FacebookSettings', ['app_id', 'app_secret'])
+
+DEFAULTS = {
+    'SECRET_KEY': 'super_super_secret_key',
+    'GOOGLE_OAUTH2_CLIENT_SECRETS_FILE': os.path.join(
+        THIS_FOLDER, 'client_secrets.json'),
+    'FACEBOOK_CLIENT_SECRETS_FILE': os.path.join(
+        THIS_FOLDER, 'fb_client_secrets.json'),
+    # Seconds reverse proxies and API clients may reuse a JSON response.
+    'JSON_CACHE_MAX_AGE': 30,
+    # Server-side cache of rendered pages: 'memory', 'filesystem' or 'null'.
+    'RESPONSE_CACHE_BACKEND': 'memory',
+    'RESPONSE_CACHE_DIR': os.path.join(INSTANCE_FOLDER, 'response-cache'),
+    # Libraries with more books than this are deleted in the background.
+    'LARGE_DELETE_THRESHOLD': 10000,
+    # Send per-request database and render timings to the browser.
+    'SERVER_TIMING': True,
+    # Requests this slow, or running this many queries, are logged.
+    'SLOW_REQUEST_MS': 500,
+    'SLOW_REQUEST_QUERIES': 50,
+    # File for the slow request log; empty to use the app's handlers.
+    'SLOW_REQUEST_LOG': '',
+    # Replicas further behind the primary than this are not read from.
+    'REPLICA_MAX_LAG': 5,
+    'REPLICA_CHECK_INTERVAL': 5,
+    # Users read from the primary this long after their own changes.
+    'REPLICA_STICKY_SECONDS': 10,
+    # Encode JSON with orjson when it is installed.
+    'FAST_JSON': True,
+    # Background jobs: the queue file shared by the app's processes, the
+    # worker threads of each process, the attempts of a failing job, the
+    # first wait before retrying it and the lease of a running job.
+    'JOB_QUEUE_FILE': os.path.join(INSTANCE_FOLDER, 'jobs.db'),
+    'JOB_WORKERS': 2,
+    'JOB_MAX_ATTEMPTS': 5,
+    'JOB_RETRY_DELAY': 2,
+    'JOB_TIMEOUT': 600,
+    # Seconds change feed entries are held back, for slow commits.
+    'CHANGE_FEED_SETTLE': 1,
+    # Compiled templates, shared by the workers: a private directory,
+    # None for one Jinja makes for this user, or empty to compile in
+    # every process.
+    'TEMPLATE_CACHE_DIR': None,
+}
+
+# Environment variable -> (config key, type).
+ENVIRONMENT = {
+    'CATALOG_SECRET_KEY': ('SECRET_KEY', str),
+    'CATALOG_GOOGLE_CLIENT_SECRETS': (
+        'GOOGLE_OAUTH2_CLIENT_SECRETS_FILE', str),
+    'CATALOG_FACEBOOK_CLIENT_SECRETS': ('FACEBOOK_CLIENT_SECRETS_FILE', str),
+    'CATALOG_JSON_CACHE_MAX_AGE': ('JSON_CACHE_MAX_AGE', int),
+    'CATALOG_RESPONSE_CACHE': ('RESPONSE_CACHE_BACKEND', str),
+    'CATALOG_RESPONSE_CACHE_DIR': ('RESPONSE_CACHE_DIR', str),
+    'CATALOG_LARGE_DELETE_THRESHOLD': ('LARGE_DELETE_THRESHOLD', int),
+    'CATALOG_SERVER_TIMING': ('SERVER_TIMING', lambda value: value != '0'),
+    'CATALOG_SLOW_REQUEST_MS': ('SLOW_REQUEST_MS', int),
+    'CATALOG_SLOW_REQUEST_QUERIES': ('SLOW_REQUEST_QUERIES', int),
+    'CATALOG_SLOW_REQUEST_LOG': ('SLOW_REQUEST_LOG', str),
+    'CATALOG_REPLICA_MAX_LAG': ('REPLICA_MAX_LAG', float),
+    'CATALOG_REPLICA_CHECK_INTERVAL': ('REPLICA_CHECK_INTERVAL', float),
+    'CATALOG_REPLICA_STICKY_SECONDS': ('REPLICA_STICKY_SECONDS', float),
+    'CATALOG_TEMPLATE_CACHE_DIR': ('TEMPLATE_CACHE_DIR', str),
+    'CATALOG_JOB_QUEUE': ('JOB_QUEUE_FILE', str),
+    'CATALOG_JOB_WORKERS': ('JOB_WORKERS', int),
+    'CATALOG_JOB_MAX_ATTEMPTS': ('JOB_MAX_ATTEMPTS', int),
+    'CATALOG_JOB_RETRY_DELAY': ('JOB_RETRY_DELAY', float),
+    'CATALOG_JOB_TIMEOUT': ('JOB_TIMEOUT', float),
+    'CATALOG_CHANGE_FEED_SETTLE': ('CHANGE_FEED_SETTLE', float),
+    'CATALOG_FAST_JSON': ('FAST_JSON', lambda value: value != '0'),
+}
+
+
+class ConfigError(Exception):
+    """The configuration is missing or invalid."""
+
+
+def private_directory(path):
+    """
+    Create directory `path` for this user only, or check an existing
+    one; return `path`. Raise ConfigError if another user owns it or
+    may write to it.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            info.st_mode & 0o022):
+        raise ConfigError('%s is not a private directory' % path)
+    return path
+
+
+def private_file(path):
+    """
+    Create file `path` for this user only, in a private directory, or
+    check an existing one; return `path`. Raise ConfigError if another
+    user owns either.
+    """
+    private_directory(os.path.dirname(os.path.abspath(path)))
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    except OSError as e:
+        raise ConfigError('Cannot open %s: %s' % (path, e))
+    try:
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid():
+            raise ConfigError('%s is not a file of this user' % path)
+        if info.st_mode & 0o077:
+            os.fchmod(fd, 0o600)
+    finally:
+        os.close(fd)
+    return path
+
+
+def read_secrets(path, fields):
+    """Return the `fields` of the 'web' section of a client secrets file."""
+    try:
+        with open(path, 'r') as f:
+            web = json.load(f)['web']
+    except (OSError, ValueError, KeyError) as e:
+        raise ConfigError('Cannot read client secrets %s: %s' % (path, e))
+    missing = [field for field in fields if not web.get(field)]
+    if missing:
+        raise ConfigError('%s is missing %s' % (path, ', '.join(missing)))
+    return dict((field, web[field]) for field in fields)
+
+
+def load_google(path):
+    """Return the Google OAuth settings."""
+    return GoogleSettings(**read_secrets(path, GoogleSettings._fields))
+
+
+def load_facebook(path):
+    """Return the Facebook OAuth settings."""
+    return FacebookSettings(**read_secrets(path, FacebookSettings._fields))
+
+
+def load_config(app):
+    """Fill and check `app.config`; raise ConfigError if it is invalid."""
+    app.config.update(DEFAULTS)
+    app.config.from_envvar('CATALOG_SETTINGS', silent=True)
+    for variable, (key, kind) in ENVIRONMENT.items():
+        if variable in os.environ:
+            try:
+                app.config[key] = kind(os.environ[variable])
+            except ValueError:
+                raise ConfigError('%s must be of type %s'
+                                  % (variable, kind.__name__))
+    if app.config['RESPONSE_CACHE_BACKEND'] not in ('memory', 'filesystem',
+                                                    'null'):
+        raise ConfigError('Unknown response cache backend %r'
+                          % app.config['RESPONSE_CACHE_BACKEND'])
+    app.config['GOOGLE_OAUTH'] = load_google(
+        app.config['GOOGLE_OAUTH2_CLIENT_SECRETS_FILE'])
+    app.config['FACEBOOK_OAUTH'] = load_facebook(
+        app.config['FACEBOOK_CLIENT_SECRETS_FILE'])
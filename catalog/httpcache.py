@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP Caching.
+
+Views decorated with @conditional() get a strong ETag and a
+Last-Modified date built from the versions of the resources they show
+(see versions.py), answer conditional GETs with 304 Not Modified
+before doing any real work, and send Cache-Control headers. Other
+responses are served from the server-side response cache when it has
+them (see responsecache.py).
+"""
+import datetime
+import hashlib
+from functools import wraps
+
+from flask import current_app, g, make_response, request
+from flask import session as login_session
+
+import reference
+import versions
+from database import session
+
+# Bump to change every ETag at once, e.g. after a template change.
+ETAG_SALT = '1'
+
+
+def resource_etag(keys, found, user=None):
+    """Return the ETag for the resource versions in `found`."""
+    parts = [ETAG_SALT, request.full_path, repr(reference.genres.all())]
+    parts.extend('%s=%d' % (key, found[key][0]) for key in sorted(keys))
+    if user is not None:
+        parts.append('user=%s' % user)
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def last_modified(found):
+    """Return the latest change time in `found`, or None."""
+    dates = [date for version, date in found.values() if date is not None]
+    return max(dates) if dates else None
+
+
+def is_fresh(etag, modified):
+    """Return True if the client copy matching the request is current."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is not None and modified is not None:
+        if since.tzinfo is not None:
+            since = since.astimezone(datetime.timezone.utc).replace(
+                tzinfo=None)
+        return modified.replace(microsecond=0) <= since
+    return False
+
+
+def conditional(keys, private=False):
+    """
+    Make a GET view cacheable by version.
+
+    `keys` is called with the view arguments and returns the resource
+    keys the page is built from. Pages that change with the logged in
+    user are `private`: their ETag depends on the user and shared
+    caches are told not to store them.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # Pending flash messages are shown once, so never cache them.
+            # Public views skip the check: reading the session would add
+            # Vary: Cookie and keep shared caches from storing them.
+            if request.method != 'GET' or (
+                    private and '_flashes' in login_session):
+                return view(**kwargs)
+            resource_keys = keys(**kwargs)
+            found = versions.current(session, resource_keys)
+            # Fragment cache keys in the templates reuse these.
+            g.resource_versions = found
+            user = login_session.get('email', '') if private else None
+            etag = resource_etag(resource_keys, found, user)
+            modified = last_modified(found)
+            cache = current_app.extensions.get('response_cache')
+            fresh = is_fresh(etag, modified)
+            cached = None
+            if not fresh and cache is not None:
+                cached = cache.get(etag)
+            if fresh:
+                response = current_app.response_class(status=304)
+            elif cached is not None:
+                status, headers, body = cached
+                response = current_app.response_class(body, status, headers)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+                if cache is not None:
+                    cache.store(etag, response)
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            if private:
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+            else:
+                response.cache_control.public = True
+                response.cache_control.max_age = current_app.config[
+                    'JSON_CACHE_MAX_AGE']
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Request Instrumentation.
+
+Records, for every request, the number of SQL statements, the time
+spent in the database, the slowest statement, the time spent rendering
+templates and the size of the response. The numbers are sent back in
+a Server-Timing header (visible in the browser's network panel),
+added up in Prometheus-style metrics served by /metrics, and requests
+over the SLOW_REQUEST_MS or SLOW_REQUEST_QUERIES thresholds are
+logged to the 'catalog.slow' logger.
+
+The metrics are kept per process; with several mod_wsgi processes each
+one reports its own.
+"""
+import logging
+import threading
+import time
+
+from flask import before_render_template, g, has_request_context, request
+from flask import template_rendered
+from sqlalchemy import event
+
+# Upper bounds of the request duration histogram, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Characters of the slowest statement kept for the slow request log.
+STATEMENT_LENGTH = 300
+
+slow_log = logging.getLogger('catalog.slow')
+
+
+class RequestStats(object):
+    """What one request spent its time on."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest = None
+        self.render_time = 0.0
+        self.rendering = []
+
+    def add_query(self, statement, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        if elapsed > self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest = statement
+
+    def server_timing(self, total):
+        """Return the Server-Timing header value."""
+        return ('db;dur=%.1f;desc="%d queries", render;dur=%.1f, '
+                'total;dur=%.1f' % (self.db_time * 1000, self.queries,
+                                    self.render_time * 1000, total * 1000))
+
+
+class Metrics(object):
+    """Request counters and histograms by endpoint, thread-safe."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.totals = {}
+
+    def record(self, endpoint, method, status, stats, elapsed, size,
+               slow):
+        """Add one finished request."""
+        with self._lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.durations.setdefault(
+                endpoint, [[0] * len(self.buckets), 0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += elapsed
+            totals = self.totals.setdefault(endpoint, [0, 0.0, 0.0, 0, 0])
+            totals[0] += stats.queries
+            totals[1] += stats.db_time
+            totals[2] += stats.render_time
+            totals[3] += size
+            totals[4] += 1 if slow else 0
+
+    def render(self, extra=()):
+        """
+        Return the metrics in the Prometheus text format.
+
+        `extra` adds (name, type, help, value) samples, e.g. the response
+        cache counters.
+        """
+        lines = []
+
+        def header(name, kind, help):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self._lock:
+            header('catalog_requests_total', 'counter',
+                   'Requests handled by endpoint, method and status.')
+            for (endpoint, method, status), count in sorted(
+                    self.requests.items()):
+                lines.append('catalog_requests_total{endpoint="%s",'
+                             'method="%s",status="%s"} %d'
+                             % (endpoint, method, status, count))
+            header('catalog_request_duration_seconds', 'histogram',
+                   'Time to build the response.')
+            for endpoint, (counts, count, total) in sorted(
+                    self.durations.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append('catalog_request_duration_seconds_bucket'
+                                 '{endpoint="%s",le="%g"} %d'
+                                 % (endpoint, bound, bucket))
+                lines.append('catalog_request_duration_seconds_bucket'
+                             '{endpoint="%s",le="+Inf"} %d'
+                             % (endpoint, count))
+                lines.append('catalog_request_duration_seconds_count'
+                             '{endpoint="%s"} %d' % (endpoint, count))
+                lines.append('catalog_request_duration_seconds_sum'
+                             '{endpoint="%s"} %.6f' % (endpoint, total))
+            for i, (name, kind, help, fmt) in enumerate((
+                    ('catalog_db_queries_total', 'counter',
+                     'SQL statements run.', '%d'),
+                    ('catalog_db_duration_seconds_total', 'counter',
+                     'Time spent running SQL statements.', '%.6f'),
+                    ('catalog_render_duration_seconds_total', 'counter',
+                     'Time spent rendering templates.', '%.6f'),
+                    ('catalog_response_bytes_total', 'counter',
+                     'Response body bytes sent.', '%d'),
+                    ('catalog_slow_requests_total', 'counter',
+                     'Requests over the slow request thresholds.', '%d'))):
+                header(name, kind, help)
+                for endpoint, totals in sorted(self.totals.items()):
+                    lines.append(('%s{endpoint="%s"} ' + fmt)
+                                 % (name, endpoint, totals[i]))
+        for name, kind, help, value in extra:
+            header(name, kind, help)
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def current_stats():
+    """Return the stats of the current request, or None."""
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    # On the statement's execution context, which goes away with it
+    # even when the statement fails and after_cursor_execute never runs.
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = getattr(context, '_query_started', None)
+    stats = current_stats()
+    if stats is not None and started is not None:
+        stats.add_query(statement, time.perf_counter() - started)
+
+
+def before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.rendering.append(time.perf_counter())
+
+
+def after_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.rendering:
+        stats.render_time += time.perf_counter() - stats.rendering.pop()
+
+
+def init_app(app, *engines):
+    """Instrument `app` and the SQL statements it runs on `engines`."""
+    app.config.setdefault('SERVER_TIMING', True)
+    app.config.setdefault('SLOW_REQUEST_MS', 500)
+    app.config.setdefault('SLOW_REQUEST_QUERIES', 50)
+    if app.config.get('SLOW_REQUEST_LOG'):
+        handler = logging.FileHandler(app.config['SLOW_REQUEST_LOG'])
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_log.addHandler(handler)
+        slow_log.setLevel(logging.WARNING)
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    before_render_template.connect(before_render, app)
+    template_rendered.connect(after_render, app)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def finish_request_stats(response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        # Streamed bodies are not read here; their size is unknown.
+        size = 0 if response.is_streamed else response.content_length or 0
+        slow = (elapsed * 1000 >= app.config['SLOW_REQUEST_MS'] or
+                stats.queries >= app.config['SLOW_REQUEST_QUERIES'])
+        if slow:
+            slow_log.warning(
+                '%s %s %d %.0fms: %d queries in %.0fms, render %.0fms, '
+                '%d bytes; slowest statement %.0fms: %s',
+                request.method, request.full_path.rstrip('?'),
+                response.status_code,
+                elapsed * 1000, stats.queries, stats.db_time * 1000,
+                stats.render_time * 1000, size, stats.slowest_time * 1000,
+                ' '.join((stats.slowest or '').split())[:STATEMENT_LENGTH])
+        metrics.record(request.endpoint or 'unknown', request.method,
+                       response.status_code, stats, elapsed, size, slow)
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = stats.server_timing(elapsed)
+        return response
+
+    return metrics
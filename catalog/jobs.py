@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background Jobs.
+
+Slow side effects of a request that the user does not have to wait
+for, such as revoking an OAuth token or deleting a large library, are
+queued here and the request returns at once.
+
+The queue is a table in a local SQLite file (JOB_QUEUE_FILE) shared by
+the app's processes, so queued jobs survive a restart. Job arguments,
+such as the tokens to revoke, are stored as they are: the file and its
+directory are created readable by the app's user only, and one owned
+by another user is refused. Each process
+runs JOB_WORKERS threads that claim jobs from it; a claim is a lease
+of JOB_TIMEOUT seconds, after which a job whose worker died is run
+again. A failing job is retried JOB_MAX_ATTEMPTS times, waiting
+JOB_RETRY_DELAY seconds, doubled after every attempt, in between.
+
+Handlers are registered by name with @handler, and must be safe to run
+more than once. /jobs/JSON shows the backlog.
+
+    python jobs.py            # run workers in the foreground
+    python jobs.py --status   # print the backlog
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from config import DEFAULTS, private_file
+from database import session
+
+log = logging.getLogger('catalog.jobs')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    key TEXT,
+    args TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    progress TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_job_state_run_at ON job (state, run_at);
+CREATE INDEX IF NOT EXISTS ix_job_name_key ON job (name, key);
+'''
+
+# Jobs a worker can claim: waiting ones, and running ones whose lease
+# ran out.
+LIVE_STATES = ('queued', 'running')
+
+Job = namedtuple('Job', 'id name key args attempts max_attempts')
+
+# Handlers by job name.
+HANDLERS = {}
+
+_current = threading.local()
+
+
+def handler(name):
+    """Register the decorated function as the handler of `name` jobs."""
+    def register(func):
+        HANDLERS[name] = func
+        return func
+    return register
+
+
+def current_job():
+    """Return the job the calling worker thread is running, or None."""
+    return getattr(_current, 'job', None)
+
+
+class JobQueue(object):
+    """A persistent job queue in a SQLite file, and its workers."""
+
+    def __init__(self, path):
+        self.path = path
+        self.timeout = 600
+        self.max_attempts = 5
+        self.retry_delay = 2
+        self.poll_interval = 1
+        self.keep = 24 * 3600
+        self.app = None
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._workers = []
+        self._schema_lock = threading.Lock()
+        self._schema_path = None
+        self._pruned = 0
+
+    def connect(self):
+        """Return this thread's connection to the queue file."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.path != self.path:
+            private_file(self.path)
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with self._schema_lock:
+                if self._schema_path != self.path:
+                    conn.executescript(SCHEMA)
+                    self._schema_path = self.path
+            self._local.conn = conn
+            self._local.path = self.path
+        return conn
+
+    def enqueue(self, name, *args, **options):
+        """
+        Queue a `name` job calling its handler with `args`.
+
+        Options: `key`, which skips the job while another `name` job
+        with the same key is queued or running; `max_attempts`; and
+        `delay`, seconds before the job may run. Returns the job id,
+        or None when skipped.
+        """
+        if name not in HANDLERS:
+            raise KeyError('No handler for %r jobs' % name)
+        key = options.get('key')
+        now = time.time()
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if key is not None and conn.execute(
+                    'SELECT 1 FROM job WHERE name = ? AND key = ? '
+                    'AND state IN (?, ?)',
+                    (name, key) + LIVE_STATES).fetchone():
+                conn.execute('COMMIT')
+                return None
+            job_id = conn.execute(
+                'INSERT INTO job (name, key, args, state, max_attempts, '
+                'run_at, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, key, json.dumps(args), 'queued',
+                 options.get('max_attempts', self.max_attempts),
+                 now + options.get('delay', 0), now, now)).lastrowid
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._wakeup.set()
+        return job_id
+
+    def claim(self):
+        """Lease the next job that is due; return it or None."""
+        conn = self.connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            while True:
+                row = conn.execute(
+                    'SELECT id, name, key, args, attempts, max_attempts, '
+                    'state FROM job WHERE state IN (?, ?) AND run_at <= ? '
+                    'ORDER BY run_at, id LIMIT 1',
+                    LIVE_STATES + (now,)).fetchone()
+                if row is None:
+                    conn.execute('COMMIT')
+                    return None
+                job = Job(row[0], row[1], row[2], json.loads(row[3]),
+                          row[4] + 1, row[5])
+                if row[6] == 'running' and row[4] >= row[5]:
+                    # Its last attempt never finished.
+                    conn.execute(
+                        'UPDATE job SET state = ?, error = ?, updated_at = ? '
+                        'WHERE id = ?',
+                        ('failed', 'Timed out', now, job.id))
+                    continue
+                conn.execute(
+                    'UPDATE job SET state = ?, attempts = ?, run_at = ?, '
+                    'updated_at = ? WHERE id = ?',
+                    ('running', job.attempts, now + self.timeout, now,
+                     job.id))
+                conn.execute('COMMIT')
+                return job
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def report(self, job, **progress):
+        """Store the progress of a running job and renew its lease."""
+        now = time.time()
+        self.connect().execute(
+            'UPDATE job SET progress = ?, run_at = ?, updated_at = ? '
+            'WHERE id = ?',
+            (json.dumps(progress), now + self.timeout, now, job.id))
+
+    def finish(self, job, error=None):
+        """Mark a job done, or failed and due for a retry."""
+        now = time.time()
+        if error is None:
+            state, run_at = 'done', now
+        elif job.attempts < job.max_attempts:
+            state = 'queued'
+            run_at = now + self.retry_delay * 2 ** (job.attempts - 1)
+        else:
+            state, run_at = 'failed', now
+        self.connect().execute(
+            'UPDATE job SET state = ?, run_at = ?, updated_at = ?, '
+            'error = ? WHERE id = ?', (state, run_at, now, error, job.id))
+
+    def run(self, job):
+        """Run a claimed job with its handler."""
+        _current.job = job
+        try:
+            if self.app is not None:
+                with self.app.app_context():
+                    HANDLERS[job.name](*job.args)
+            else:
+                HANDLERS[job.name](*job.args)
+        except Exception as e:
+            log.warning('Job %d %s attempt %d/%d failed: %s', job.id,
+                        job.name, job.attempts, job.max_attempts, e,
+                        exc_info=True)
+            self.finish(job, '%s: %s' % (type(e).__name__, e))
+        else:
+            self.finish(job)
+        finally:
+            _current.job = None
+            # Handlers use the scoped database session.
+            session.remove()
+
+    def work(self):
+        """Run jobs until stop() is called."""
+        while not self._stopping.is_set():
+            try:
+                job = self.claim()
+            except sqlite3.Error as e:
+                log.warning('Cannot claim a job: %s', e)
+                job = None
+            if job is not None:
+                self.run(job)
+                continue
+            self.prune()
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def start(self, workers):
+        """Start `workers` worker threads."""
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work, name='catalog-job')
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the worker threads after their current jobs."""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._workers:
+            thread.join(timeout)
+        self._workers = []
+        self._stopping.clear()
+
+    def prune(self):
+        """Forget finished jobs older than `keep` seconds, once a minute."""
+        now = time.time()
+        if now - self._pruned < 60:
+            return
+        self._pruned = now
+        try:
+            self.connect().execute(
+                'DELETE FROM job WHERE state IN (?, ?) AND updated_at < ?',
+                ('done', 'failed', now - self.keep))
+        except sqlite3.Error as e:
+            log.warning('Cannot prune jobs: %s', e)
+
+    def find(self, name, key):
+        """Return the latest `name` job with `key` as a dict, or None."""
+        row = self.connect().execute(
+            'SELECT id, args, state, attempts, progress, error, created_at, '
+            'updated_at FROM job WHERE name = ? AND key = ? '
+            'ORDER BY id DESC LIMIT 1', (name, key)).fetchone()
+        if row is None:
+            return None
+        return {'id': row[0], 'args': json.loads(row[1]), 'state': row[2],
+                'attempts': row[3],
+                'progress': json.loads(row[4]) if row[4] else None,
+                'error': row[5], 'created_at': row[6], 'updated_at': row[7]}
+
+    def backlog(self, errors=False):
+        """
+        Return the number of jobs by state and name, queue ages and the
+        latest failures, with their error messages if `errors`.
+        """
+        conn = self.connect()
+        now = time.time()
+        jobs = {}
+        for state, name, count in conn.execute(
+                'SELECT state, name, COUNT(*) FROM job '
+                'GROUP BY state, name'):
+            jobs.setdefault(state, {})[name] = count
+        oldest = conn.execute(
+            'SELECT MIN(created_at) FROM job WHERE state = ?',
+            ('queued',)).fetchone()[0]
+        failures = []
+        for row in conn.execute(
+                'SELECT id, name, attempts, error, updated_at FROM job '
+                'WHERE error IS NOT NULL AND state != ? '
+                'ORDER BY updated_at DESC LIMIT 10', ('done',)):
+            failure = {'id': row[0], 'name': row[1], 'attempts': row[2],
+                       'updated_at': row[4]}
+            if errors:
+                failure['error'] = row[3]
+            failures.append(failure)
+        return {
+            'counts': dict((state, sum(names.values()))
+                           for state, names in jobs.items()),
+            'jobs': jobs,
+            'oldest_queued_seconds': round(now - oldest, 3)
+            if oldest is not None else 0,
+            'recent_failures': failures,
+            'workers': len(self._workers),
+        }
+
+
+queue = JobQueue(DEFAULTS['JOB_QUEUE_FILE'])
+
+
+def enqueue(name, *args, **options):
+    """Queue a job on the app's queue; see JobQueue.enqueue()."""
+    return queue.enqueue(name, *args, **options)
+
+
+def report(**progress):
+    """Store the progress of the job the calling thread runs."""
+    job = current_job()
+    if job is not None:
+        queue.report(job, **progress)
+
+
+def init_app(app):
+    """Configure the job queue and start the workers of `app`."""
+    config = app.config
+    queue.path = config.get('JOB_QUEUE_FILE', queue.path)
+    queue.timeout = config.get('JOB_TIMEOUT', queue.timeout)
+    queue.max_attempts = config.get('JOB_MAX_ATTEMPTS', queue.max_attempts)
+    queue.retry_delay = config.get('JOB_RETRY_DELAY', queue.retry_delay)
+    queue.app = app
+    private_file(queue.path)
+    if not queue._workers:
+        queue.start(config.get('JOB_WORKERS', 2))
+    return queue
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Run the catalog background jobs.')
+    parser.add_argument('--status', action='store_true',
+                        help='print the backlog and exit')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='worker threads')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # The handlers are registered by the app's modules, and its own
+    # workers are not wanted here.
+    os.environ['CATALOG_JOB_WORKERS'] = '0'
+    from application import create_app
+    create_app()
+    if args.status:
+        print(json.dumps(queue.backlog(errors=True), indent=2, sort_keys=True))
+        return
+    queue.start(args.workers)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        queue.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Schema Migrations.
+
+Numbered, forward-only migrations for the library database. The
+version reached is kept in the `schema_version` table and a database
+gets the migrations it has not seen yet. A new database is first
+created straight from the models, so every migration must be safe to
+run on a schema that already has its changes.
+
+Run `python migrations.py` (or `python librarydb_setup.py`) to upgrade.
+"""
+import argparse
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from database import engine
+from librarydb_setup import Base, Book, Change, Genre, Library
+from librarydb_setup import ResourceVersion, record_selected_changes
+import bookcounts
+import search
+
+version_table = Table('schema_version', MetaData(),
+                      Column('version', Integer, nullable=False))
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """Register `func` as the next schema migration."""
+    MIGRATIONS.append(func)
+    return func
+
+
+def quote(bind, name):
+    """Quote a table or column name for the bound dialect."""
+    return bind.dialect.identifier_preparer.quote(name)
+
+
+def create_index(bind, name, table, columns, unique=False):
+    """
+    Create an index unless it already exists.
+
+    On Postgres the index is built CONCURRENTLY so the table stays
+    writable while it is built; that has to run outside a transaction.
+    """
+    sql = 'CREATE %sINDEX %sIF NOT EXISTS %s ON %s (%s)' % (
+        'UNIQUE ' if unique else '',
+        'CONCURRENTLY ' if bind.dialect.name == 'postgresql' else '',
+        quote(bind, name), quote(bind, table),
+        ', '.join(quote(bind, c) for c in columns))
+    with bind.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        conn.execute(text(sql))
+
+
+def has_column(bind, table, column):
+    """Return True if `table` already has `column`."""
+    return column in [c['name'] for c in inspect(bind).get_columns(table)]
+
+
+@migration
+def add_book_created_at(bind):
+    """Add Book.created_at and the index behind the latest books feed."""
+    if not has_column(bind, 'book', 'created_at'):
+        column_type = Book.__table__.c.created_at.type.compile(
+            dialect=bind.dialect)
+        with bind.begin() as conn:
+            if bind.dialect.name == 'sqlite':
+                # SQLite can only add columns with a constant default.
+                conn.execute(text('ALTER TABLE book ADD COLUMN created_at %s'
+                                  % column_type))
+                conn.execute(text('UPDATE book SET created_at = '
+                                  'CURRENT_TIMESTAMP'))
+            else:
+                conn.execute(text('ALTER TABLE book ADD COLUMN created_at %s '
+                                  'NOT NULL DEFAULT CURRENT_TIMESTAMP'
+                                  % column_type))
+    create_index(bind, 'ix_book_created_at_id', 'book', ['created_at', 'id'])
+
+
+@migration
+def add_lookup_indexes(bind):
+    """Index the foreign keys and make User.email unique."""
+    create_index(bind, 'ix_book_genre_id', 'book', ['genre_id'])
+    create_index(bind, 'ix_book_library_id', 'book', ['library_id'])
+    create_index(bind, 'ix_book_user_id', 'book', ['user_id'])
+    create_index(bind, 'ix_library_user_id', 'library', ['user_id'])
+
+    # Merge users that signed up twice with the same email into the
+    # oldest account before the unique index can be built.
+    user = quote(bind, 'user')
+    oldest = ('(SELECT MIN(d.id) FROM %s u JOIN %s d ON d.email = u.email '
+              'WHERE u.id = %%(table)s.user_id)' % (user, user))
+    duplicates = ('(SELECT u.id FROM %s u WHERE EXISTS (SELECT 1 FROM %s d '
+                  'WHERE d.email = u.email AND d.id < u.id))' % (user, user))
+    with bind.begin() as conn:
+        for table in ('book', 'library'):
+            conn.execute(text('UPDATE %s SET user_id = %s WHERE user_id IN %s'
+                              % (table, oldest % {'table': table},
+                                 duplicates)))
+        conn.execute(text('DELETE FROM %s WHERE id IN %s'
+                          % (user, duplicates)))
+    create_index(bind, 'ix_user_email', 'user', ['email'], unique=True)
+
+
+@migration
+def add_resource_version(bind):
+    """Add the table behind HTTP ETags and cache invalidation."""
+    ResourceVersion.__table__.create(bind, checkfirst=True)
+
+
+@migration
+def add_book_search_index(bind):
+    """Add the full-text index behind /search."""
+    if bind.dialect.name == 'postgresql':
+        with bind.connect() as conn:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+            conn.execute(text('CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                              'ix_book_search ON book USING gin (%s)'
+                              % search.PG_DOCUMENT))
+    elif bind.dialect.name == 'sqlite':
+        statements = [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5("
+            "title, author, description, content='book', content_rowid='id')",
+            "CREATE TRIGGER IF NOT EXISTS book_search_insert AFTER INSERT "
+            "ON book BEGIN INSERT INTO book_search(rowid, title, author, "
+            "description) VALUES (new.id, new.title, new.author, "
+            "new.description); END",
+            "CREATE TRIGGER IF NOT EXISTS book_search_delete AFTER DELETE "
+            "ON book BEGIN INSERT INTO book_search(book_search, rowid, "
+            "title, author, description) VALUES ('delete', old.id, "
+            "old.title, old.author, old.description); END",
+            "CREATE TRIGGER IF NOT EXISTS book_search_update AFTER UPDATE "
+            "ON book BEGIN INSERT INTO book_search(book_search, rowid, "
+            "title, author, description) VALUES ('delete', old.id, "
+            "old.title, old.author, old.description); "
+            "INSERT INTO book_search(rowid, title, author, description) "
+            "VALUES (new.id, new.title, new.author, new.description); END",
+            "INSERT INTO book_search(book_search) VALUES ('rebuild')",
+        ]
+        try:
+            with bind.begin() as conn:
+                for statement in statements:
+                    conn.execute(text(statement))
+        except OperationalError:
+            # SQLite built without FTS5: search falls back to LIKE.
+            print("FTS5 is not available, search will scan the book table")
+
+
+@migration
+def cascade_library_books(bind):
+    """Delete a library's books in the database when it is deleted."""
+    if bind.dialect.name != 'postgresql':
+        # SQLite cannot alter constraints; deleteLibrary deletes the
+        # books itself with one statement.
+        return
+    for fk in inspect(bind).get_foreign_keys('book'):
+        if (fk['referred_table'] == 'library'
+                and fk.get('options', {}).get('ondelete') != 'CASCADE'):
+            # NOT VALID skips the full table check under lock; VALIDATE
+            # then checks the rows without blocking writes.
+            with bind.begin() as conn:
+                conn.execute(text(
+                    'ALTER TABLE book DROP CONSTRAINT %s, ADD CONSTRAINT %s '
+                    'FOREIGN KEY (library_id) REFERENCES library (id) '
+                    'ON DELETE CASCADE NOT VALID'
+                    % (quote(bind, fk['name']), quote(bind, fk['name']))))
+            with bind.begin() as conn:
+                conn.execute(text('ALTER TABLE book VALIDATE CONSTRAINT %s'
+                                  % quote(bind, fk['name'])))
+
+
+@migration
+def add_book_counts(bind):
+    """Add Library.book_count and Genre.book_count and fill them."""
+    for model in (Library, Genre):
+        table = model.__tablename__
+        if not has_column(bind, table, 'book_count'):
+            with bind.begin() as conn:
+                conn.execute(text('ALTER TABLE %s ADD COLUMN book_count '
+                                  'INTEGER NOT NULL DEFAULT 0'
+                                  % quote(bind, table)))
+    with bind.begin() as conn:
+        bookcounts.reconcile(conn)
+
+
+@migration
+def add_change_log(bind):
+    """Add the change feed, starting with every library and book."""
+    Change.__table__.create(bind, checkfirst=True)
+    with bind.begin() as conn:
+        if conn.execute(select(Change.seq).limit(1)).first() is None:
+            record_selected_changes(conn, 'library', select(Library.id))
+            record_selected_changes(conn, 'book', select(Book.id))
+
+
+def current_version(bind):
+    """Return the schema version of the database, 0 if never stamped."""
+    version_table.create(bind, checkfirst=True)
+    with bind.connect() as conn:
+        version = conn.execute(version_table.select()).scalar()
+    return version or 0
+
+
+def stamp(bind, version):
+    """Record that the database is at `version`."""
+    version_table.create(bind, checkfirst=True)
+    with bind.begin() as conn:
+        conn.execute(version_table.delete())
+        conn.execute(version_table.insert().values(version=version))
+
+
+def upgrade(bind=engine):
+    """Bring the database schema up to the latest version."""
+    if 'book' not in inspect(bind).get_table_names():
+        Base.metadata.create_all(bind)
+    version = current_version(bind)
+    for number, func in enumerate(MIGRATIONS[version:], version + 1):
+        print("Applying migration %d: %s" % (number, func.__name__))
+        func(bind)
+        stamp(bind, number)
+    return len(MIGRATIONS)
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description='Create or upgrade the library database schema.')
+    parser.add_argument('--show', action='store_true',
+                        help='print the current version and exit')
+    args = parser.parse_args()
+    if args.show:
+        print("Database at version %d of %d"
+              % (current_version(engine), len(MIGRATIONS)))
+        return
+    print("Database at version %d" % upgrade(engine))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON Pagination.
+
+Keyset (cursor) pagination and streaming for the JSON list endpoints.
+
+A page is requested with `?limit=<n>&after=<id>` and carries a `next`
+link to the following page. `?stream=ndjson` or `?stream=json` sends
+every row instead, read from a server-side cursor in batches so memory
+stays flat however big the list is.
+
+Rows are turned into JSON objects by their serialize property, or by
+the `serialize` function given for column rows (see serialization.py).
+"""
+from operator import attrgetter
+
+from flask import Response, abort, current_app, jsonify, request
+from flask import stream_with_context
+from flask import url_for
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+
+
+def page_args():
+    """Return the (limit, after) cursor arguments of the request."""
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    after = request.args.get('after', 0, type=int)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE), after
+
+
+def keyset_page(query, key, limit, after):
+    """
+    Return one page of `query` ordered by the `key` column.
+
+    Returns the rows and the key value to continue after, or None
+    when this is the last page.
+    """
+    if after:
+        query = query.filter(key > after)
+    rows = query.order_by(key).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, getattr(rows[-1], key.key)
+    return rows, None
+
+
+def stream_rows(name, query, key, mode, serialize):
+    """Stream every row of `query` as NDJSON or as one JSON document."""
+    rows = query.order_by(key).execution_options(
+        stream_results=True).yield_per(STREAM_BATCH_SIZE)
+    dumps = current_app.json.dumps
+
+    def generate_ndjson():
+        for row in rows:
+            yield dumps(serialize(row)) + '\n'
+
+    def generate_json():
+        yield '{"%s": [' % name
+        separator = ''
+        for row in rows:
+            yield separator + dumps(serialize(row))
+            separator = ', '
+        yield ']}\n'
+
+    if mode == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()),
+                        mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()),
+                    mimetype='application/json')
+
+
+def paginated_json(name, query, key, serialize=attrgetter('serialize')):
+    """Return the JSON list response for `query`, paged or streamed."""
+    mode = request.args.get('stream')
+    if mode is not None:
+        if mode not in ('ndjson', 'json'):
+            abort(400)
+        return stream_rows(name, query, key, mode, serialize)
+    limit, after = page_args()
+    rows, last = keyset_page(query, key, limit, after)
+    next_url = None
+    if last is not None:
+        # Keep ?fields= and the other arguments that shape the list.
+        args = request.args.to_dict(flat=False)
+        args.update(request.view_args, after=last, limit=limit)
+        next_url = url_for(request.endpoint, _external=True, **args)
+    return jsonify({name: [serialize(i) for i in rows], 'next': next_url})
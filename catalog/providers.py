@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OAuth Provider Client.
+
+One pooled, keep-alive HTTP session shared by every request that talks
+to Google or Facebook, with strict timeouts and retries on transient
+errors. Independent lookups run concurrently on a small thread pool,
+and Google tokeninfo answers are cached for a short while.
+
+The provider base URLs can be pointed at a local stub server with the
+CATALOG_GOOGLE_API, CATALOG_GOOGLE_ACCOUNTS and CATALOG_FACEBOOK_GRAPH
+environment variables.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from caching import MemoryCache
+
+GOOGLE_API = os.environ.get('CATALOG_GOOGLE_API',
+                            'https://www.googleapis.com')
+GOOGLE_ACCOUNTS = os.environ.get('CATALOG_GOOGLE_ACCOUNTS',
+                                 'https://accounts.google.com')
+FACEBOOK_GRAPH = os.environ.get('CATALOG_FACEBOOK_GRAPH',
+                                'https://graph.facebook.com')
+
+# (connect, read) timeouts in seconds.
+TIMEOUT = (3.05, 5)
+
+http = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                       max_retries=Retry(total=2, backoff_factor=0.2,
+                                         status_forcelist=(502, 503, 504)))
+http.mount('https://', _adapter)
+http.mount('http://', _adapter)
+
+_executor = ThreadPoolExecutor(max_workers=8)
+
+# Tokeninfo answers by access token.
+_tokeninfo = MemoryCache(maxsize=1024, ttl=60)
+
+
+class ProviderError(Exception):
+    """The provider could not be reached or gave an unusable answer."""
+
+
+def call(method, url, **params):
+    """Call a provider endpoint and return the response."""
+    try:
+        return http.request(method, url, params=params, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        # Not str(e): it holds the full URL, tokens included.
+        raise ProviderError('%s %s failed: %s'
+                            % (method, url, type(e).__name__))
+
+
+def call_json(method, url, **params):
+    """Call a provider endpoint and return its decoded JSON answer."""
+    try:
+        return call(method, url, **params).json()
+    except ValueError as e:
+        raise ProviderError('Invalid JSON from %s: %s' % (url, e))
+
+
+def submit(func, *args):
+    """Run `func(*args)` on the provider thread pool; return a future."""
+    return _executor.submit(func, *args)
+
+
+def google_tokeninfo(access_token):
+    """Return what Google knows about an access token."""
+    result = _tokeninfo.get(access_token)
+    if result is None:
+        result = call_json('GET', GOOGLE_API + '/oauth2/v1/tokeninfo',
+                           access_token=access_token)
+        if result.get('error') is None:
+            _tokeninfo.set(access_token, result)
+    return result
+
+
+def google_userinfo(access_token):
+    """Return the Google profile of the token's user."""
+    return call_json('GET', GOOGLE_API + '/oauth2/v1/userinfo',
+                     access_token=access_token, alt='json')
+
+
+def google_revoke(access_token):
+    """Revoke a Google access token; return True on success."""
+    _tokeninfo.delete(access_token)
+    return call('GET', GOOGLE_ACCOUNTS + '/o/oauth2/revoke',
+                token=access_token).status_code == 200
+
+
+def facebook_exchange_token(app_id, app_secret, access_token):
+    """Exchange a short-lived Facebook token for a long-lived one."""
+    result = call_json('GET', FACEBOOK_GRAPH + '/oauth/access_token',
+                       grant_type='fb_exchange_token', client_id=app_id,
+                       client_secret=app_secret,
+                       fb_exchange_token=access_token)
+    if 'access_token' not in result:
+        raise ProviderError('Facebook token exchange failed: %s' % result)
+    return result['access_token']
+
+
+def facebook_me(access_token):
+    """Return the Facebook profile of the token's user."""
+    return call_json('GET', FACEBOOK_GRAPH + '/v2.8/me',
+                     access_token=access_token, fields='name,id,email')
+
+
+def facebook_picture(access_token):
+    """Return the Facebook picture URL of the token's user."""
+    result = call_json('GET', FACEBOOK_GRAPH + '/v2.8/me/picture',
+                       access_token=access_token, redirect=0, height=200,
+                       width=200)
+    return result['data']['url']
+
+
+def facebook_revoke(facebook_id, access_token):
+    """Revoke the app's Facebook permissions for a user."""
+    return call('DELETE', FACEBOOK_GRAPH + '/%s/permissions' % facebook_id,
+                access_token=access_token).status_code == 200
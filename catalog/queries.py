@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Query Profiles.
+
+Eager loading options for the read endpoints, so a listing runs a fixed
+number of queries no matter how many rows it returns.
+"""
+from sqlalchemy.orm import raiseload
+
+# Books rendered or serialized on their own. Genre names come from
+# reference.genres, so nothing else is loaded and any lazy load raises.
+BOOK_LISTING = (raiseload('*'),)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reference Data.
+
+Small tables that almost never change, such as the book genres, are
+read once and kept in memory. Pages and serializers look names up here
+instead of joining or lazy loading them from the database.
+"""
+import threading
+import time
+from collections import namedtuple
+
+GenreRef = namedtuple('GenreRef', ['id', 'name'])
+
+
+class ReferenceData(object):
+    """
+    In-memory copy of a reference table.
+
+    The rows are reloaded after `ttl` seconds, so changes made from
+    another process show up, or right away after invalidate(). Asking
+    for an unknown id also reloads them, at most once every
+    `miss_interval` seconds, so rows added by another process are found
+    at once. `version` goes up each time the loaded rows change.
+    """
+
+    def __init__(self, loader, ttl=300, miss_interval=1):
+        self.loader = loader
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+        self.version = 0
+        self._rows = None
+        self._by_id = {}
+        self._expires = 0
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._rows is not None and self._expires > time.time():
+                return
+            rows = list(self.loader())
+            if rows != self._rows:
+                self.version += 1
+            self._rows = rows
+            self._by_id = dict((row.id, row) for row in rows)
+            self._loaded = time.time()
+            self._expires = self._loaded + self.ttl
+
+    def all(self):
+        """Return every row."""
+        self._load()
+        return self._rows
+
+    def get(self, row_id):
+        """Return the row with `row_id`, or None."""
+        self._load()
+        row = self._by_id.get(row_id)
+        if row is None and row_id is not None:
+            with self._lock:
+                if self._loaded + self.miss_interval <= time.time():
+                    self._expires = 0
+            self._load()
+            row = self._by_id.get(row_id)
+        return row
+
+    def name(self, row_id):
+        """Return the name of the row with `row_id`, or None."""
+        row = self.get(row_id)
+        return row.name if row is not None else None
+
+    def invalidate(self):
+        """Reload the rows on next use."""
+        with self._lock:
+            self._expires = 0
+
+
+def load_genres():
+    """Read the genres table."""
+    from database import session
+    from librarydb_setup import Genre
+    return [GenreRef(g.id, g.name)
+            for g in session.query(Genre).order_by(Genre.id)]
+
+
+genres = ReferenceData(load_genres)
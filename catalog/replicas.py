@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Read Replica Routing.
+
+Views decorated with @read_only() read from one of the replica engines
+(CATALOG_DATABASE_REPLICAS, see database.py) instead of the primary.
+Everything else, and every write, goes to the primary.
+
+- Read your writes: after a user commits a change, their own requests
+  read from the primary for REPLICA_STICKY_SECONDS, so they see it.
+  Public views, @read_only(public=True), are the same for every user
+  and never read the session, which would add Vary: Cookie to them:
+  they may show a user's change only REPLICA_MAX_LAG seconds later.
+- Lag: every REPLICA_CHECK_INTERVAL seconds each replica's latest
+  resource version change is compared with the primary's; a replica
+  more than REPLICA_MAX_LAG seconds behind, or one that cannot be
+  reached, is skipped until a later check finds it has caught up.
+"""
+import datetime
+import itertools
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, has_request_context, request
+from flask import session as login_session
+from sqlalchemy import func, select
+from sqlalchemy.exc import DBAPIError
+
+import versions
+from database import engine, replica_engines, session
+from librarydb_setup import ResourceVersion
+
+LAST_WRITE = 'last_write'
+
+
+class ReplicaSet(object):
+    """Pick a replica that is reachable and not too far behind."""
+
+    def __init__(self, engines, primary=engine):
+        self.engines = engines
+        self.primary = primary
+        self.max_lag = 5
+        self.check_interval = 5
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._healthy = list(engines)
+        self._next = itertools.count()
+
+    def latest_change(self, bind):
+        """Return the time of the latest resource change in `bind`."""
+        with bind.connect() as conn:
+            return conn.execute(
+                select(func.max(ResourceVersion.updated_at))).scalar()
+
+    def lag(self, replica):
+        """
+        Return how many seconds `replica` is behind, None if unknown.
+
+        That is the age of the oldest change the primary has and the
+        replica does not.
+        """
+        try:
+            latest = self.latest_change(replica)
+        except DBAPIError:
+            return None
+        missing = select(func.min(ResourceVersion.updated_at))
+        if latest is not None:
+            missing = missing.where(ResourceVersion.updated_at > latest)
+        with self.primary.connect() as conn:
+            oldest = conn.execute(missing).scalar()
+        if oldest is None:
+            return 0
+        return max((datetime.datetime.utcnow() - oldest).total_seconds(), 0)
+
+    def check(self):
+        """Find the healthy replicas again if the last check is old."""
+        with self._lock:
+            if time.time() - self._checked < self.check_interval:
+                return
+            self._checked = time.time()
+            healthy = []
+            try:
+                for replica in self.engines:
+                    lag = self.lag(replica)
+                    if lag is not None and lag <= self.max_lag:
+                        healthy.append(replica)
+            except DBAPIError:
+                # The primary is down; keep the last verdict.
+                return
+            self._healthy = healthy
+
+    def choose(self):
+        """Return a healthy replica engine, or None to use the primary."""
+        if not self.engines:
+            return None
+        self.check()
+        healthy = self._healthy
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+
+replica_set = ReplicaSet(replica_engines)
+
+
+def wrote_recently():
+    """Return True if the logged in user committed a change recently."""
+    if not replica_set.engines:
+        return False
+    last_write = login_session.get(LAST_WRITE, 0)
+    sticky = current_app.config.get('REPLICA_STICKY_SECONDS', 10)
+    return time.time() - last_write < sticky
+
+
+def read_only(view=None, public=False):
+    """Let a view read from a replica when the user allows it."""
+    if view is None:
+        return lambda view: read_only(view, public)
+
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if request.method in ('GET', 'HEAD') and replica_set.engines and (
+                public or not wrote_recently()):
+            replica = replica_set.choose()
+            if replica is not None:
+                session.info['replica'] = replica
+        return view(*args, **kwargs)
+    return decorated
+
+
+@versions.on_change
+def remember_write(keys):
+    """Send the user's next reads to the primary."""
+    if replica_set.engines and has_request_context():
+        login_session[LAST_WRITE] = time.time()
+
+
+def init_app(app):
+    """Configure the replica checks for `app`."""
+    replica_set.max_lag = app.config.get('REPLICA_MAX_LAG', 5)
+    replica_set.check_interval = app.config.get('REPLICA_CHECK_INTERVAL', 5)
+    return replica_set
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Server-side Response Cache.
+
+Stores rendered responses so identical requests skip the queries and
+the template rendering. Entries are keyed by the resource ETag built in
+httpcache.py, which covers the endpoint, its arguments, the logged in
+user and the version of every resource the page shows. A mutation that
+touches a resource therefore retires exactly the pages built from it,
+in every process, and stale entries simply age out.
+
+Backends:
+- 'memory': an LRU in each process.
+- 'filesystem': one file per entry in RESPONSE_CACHE_DIR, shared by all
+  the mod_wsgi processes on the host. The directory must belong to the
+  app's user and not be writable by others; an entry is its status and
+  headers as a line of JSON, followed by the body.
+- 'null': caching disabled.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from caching import MemoryCache
+from config import private_directory
+
+
+class NullBackend(object):
+    """Backend that stores nothing."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class MemoryBackend(MemoryCache):
+    """Per-process LRU backend."""
+
+
+class FileSystemBackend(object):
+    """Backend keeping one file per entry in `directory`."""
+
+    def __init__(self, directory, ttl=300):
+        self.directory = private_directory(directory)
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.cache')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                status, headers = json.loads(f.readline().decode('utf-8'))
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return status, [tuple(header) for header in headers], body
+
+    def set(self, key, value):
+        # Write to a temporary file first so readers never see half an
+        # entry, then move it into place.
+        status, headers, body = value
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps([status, headers]).encode('utf-8') + b'\n')
+            f.write(body)
+        os.replace(tmp, self._path(key))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.directory)
+                    if name.endswith('.cache')])
+
+
+class ResponseCache(object):
+    """Response store with hit and miss counters."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the (status, headers, body) stored under `key`, or None."""
+        entry = self.backend.get(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def store(self, key, response):
+        """Store `response` under `key` if it can be replayed."""
+        if response.status_code != 200 or response.is_streamed:
+            return
+        headers = [(name, value) for name, value in response.headers
+                   if name.lower() != 'set-cookie']
+        self.backend.set(key, (response.status_code, headers,
+                               response.get_data()))
+        with self._lock:
+            self.stores += 1
+
+    def clear(self):
+        """Drop every entry."""
+        self.backend.clear()
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._lock:
+            return {'backend': type(self.backend).__name__,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'stores': self.stores,
+                    'entries': len(self.backend)}
+
+
+def init_app(app):
+    """Create the response cache configured for `app`."""
+    kind = app.config.get('RESPONSE_CACHE_BACKEND', 'memory')
+    ttl = app.config.get('RESPONSE_CACHE_TTL', 300)
+    if kind == 'memory':
+        backend = MemoryBackend(
+            maxsize=app.config.get('RESPONSE_CACHE_SIZE', 512), ttl=ttl)
+    elif kind == 'filesystem':
+        backend = FileSystemBackend(app.config['RESPONSE_CACHE_DIR'], ttl=ttl)
+    elif kind == 'null':
+        backend = NullBackend()
+    else:
+        raise ValueError('Unknown RESPONSE_CACHE_BACKEND %r' % kind)
+    cache = ResponseCache(backend)
+    app.extensions['response_cache'] = cache
+    return cache
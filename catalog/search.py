@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Book Search.
+
+Full-text search over book titles, authors and descriptions, served by
+the database's own text index:
+- Postgres: a GIN index on the book tsvector, ranked with ts_rank_cd.
+- SQLite: the book_search FTS5 table, kept in sync with book by
+  triggers and ranked with bm25.
+Other databases fall back to a LIKE scan.
+
+Only the first MAX_CANDIDATES rows the index matches are ranked, so a
+common word costs the same at a million books as at ten thousand; past
+that the ranking is among those candidates rather than every match.
+Results are paged with limit/offset and capped at MAX_RESULTS.
+"""
+import re
+
+from sqlalchemy import inspect, or_, text
+
+from librarydb_setup import Book
+
+MAX_RESULTS = 1000
+# Index matches ranked per query.
+MAX_CANDIDATES = 10000
+
+# Expression the Postgres GIN index is built on; queries must repeat
+# it exactly for the planner to use the index.
+PG_DOCUMENT = ("to_tsvector('english', coalesce(title, '') || ' ' || "
+               "coalesce(author, '') || ' ' || coalesce(description, ''))")
+
+_has_fts = {}
+
+
+def search_terms(query):
+    """Return the words of a user query."""
+    return re.findall(r'\w+', query.lower())
+
+
+def has_fts_table(bind):
+    """Return True if the SQLite database has the book_search table."""
+    key = str(bind.url)
+    if key not in _has_fts:
+        _has_fts[key] = 'book_search' in inspect(bind).get_table_names()
+    return _has_fts[key]
+
+
+def matching_ids(session, terms, limit, offset):
+    """Return the ids of the books matching `terms`, best match first."""
+    bind = session.get_bind()
+    params = {'limit': limit, 'offset': offset,
+              'candidates': MAX_CANDIDATES}
+    if bind.dialect.name == 'postgresql':
+        params['query'] = ' '.join(terms)
+        sql = ("SELECT id FROM (SELECT id, %(doc)s AS doc FROM book "
+               "WHERE %(doc)s @@ plainto_tsquery('english', :query) "
+               "LIMIT :candidates) AS candidate "
+               "ORDER BY ts_rank_cd(doc, "
+               "plainto_tsquery('english', :query)) DESC, id "
+               "LIMIT :limit OFFSET :offset" % {'doc': PG_DOCUMENT})
+    elif bind.dialect.name == 'sqlite' and has_fts_table(bind):
+        # Quote every word so FTS5 operators in user input are inert.
+        params['query'] = ' '.join('"%s"' % term for term in terms)
+        sql = ("SELECT rowid FROM (SELECT rowid, "
+               "bm25(book_search, 10.0, 5.0, 1.0) AS score "
+               "FROM book_search WHERE book_search MATCH :query "
+               "LIMIT :candidates) ORDER BY score, rowid "
+               "LIMIT :limit OFFSET :offset")
+    else:
+        query = session.query(Book.id)
+        for term in terms:
+            pattern = '%' + term + '%'
+            query = query.filter(or_(Book.title.ilike(pattern),
+                                     Book.author.ilike(pattern),
+                                     Book.description.ilike(pattern)))
+        return [row.id for row in
+                query.order_by(Book.id).limit(limit).offset(offset)]
+    return [row[0] for row in session.execute(text(sql), params)]
+
+
+def search_books(session, query, limit, offset=0, options=()):
+    """
+    Return one page of books matching `query`, best match first.
+
+    Returns the books and the offset of the next page, or None when
+    there are no more results.
+    """
+    terms = search_terms(query)
+    if not terms or offset >= MAX_RESULTS:
+        return [], None
+    limit = min(limit, MAX_RESULTS - offset)
+    ids = matching_ids(session, terms, limit + 1, offset)
+    next_offset = None
+    if len(ids) > limit and offset + limit < MAX_RESULTS:
+        next_offset = offset + limit
+    ids = ids[:limit]
+    if not ids:
+        return [], None
+    books = dict((book.id, book) for book in session.query(Book).options(
+        *options).filter(Book.id.in_(ids)))
+    return [books[i] for i in ids if i in books], next_offset
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON Serialization.
+
+The JSON list endpoints select only the columns of the objects they
+send, as plain rows, instead of loading ORM objects: no identity map,
+no attribute tracking. A Projection names the fields of one kind of
+object, the column behind each and how to turn its value into JSON,
+and gives the same dicts as the models' serialize properties.
+
+`?fields=id,title` selects some of the fields; only their columns (and
+the key column pages are ordered by) are read.
+
+When orjson is installed, the app encodes its JSON with it.
+"""
+from flask import abort, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import reference
+from librarydb_setup import Book, Library, User
+
+
+class Projection(object):
+    """The columns behind the fields of a JSON object."""
+
+    def __init__(self, key, fields, joins=None):
+        # fields: [(name, column, convert or None)], in output order.
+        self.key = key
+        self.fields = dict((name, (column, convert))
+                           for name, column, convert in fields)
+        self.names = [name for name, column, convert in fields]
+        # {field name: relationship to outer join for it}
+        self.joins = joins or {}
+
+    def requested(self):
+        """Return the field names asked for by `?fields=`, or all."""
+        fields = request.args.get('fields')
+        if fields is None:
+            return self.names
+        names = []
+        for name in fields.split(','):
+            name = name.strip()
+            if name not in self.fields:
+                abort(400)
+            if name not in names:
+                names.append(name)
+        if not names:
+            abort(400)
+        return names
+
+    def select(self, session, names=None):
+        """
+        Return a query of the rows of `names` and their serializer.
+
+        Every row also has the key column, named after it, so it can
+        be paged by it.
+        """
+        if names is None:
+            names = self.requested()
+        columns = [self.fields[name][0].label(name) for name in names]
+        if self.key.key not in names:
+            columns.append(self.key.label(self.key.key))
+        query = session.query(*columns).select_from(self.key.class_)
+        for name in names:
+            if name in self.joins:
+                query = query.outerjoin(self.joins[name])
+        readers = [(name, i, self.fields[name][1])
+                   for i, name in enumerate(names)]
+
+        def serialize(row):
+            return dict((name, row[i] if convert is None
+                         else convert(row[i]))
+                        for name, i, convert in readers)
+        return query, serialize
+
+
+BOOK_FIELDS = [
+    ('title', Book.title, None),
+    ('id', Book.id, None),
+    ('author', Book.author, None),
+    ('genre', Book.genre_id, reference.genres.name),
+    ('description', Book.description, None),
+]
+BOOK = Projection(Book.id, BOOK_FIELDS)
+
+LIBRARY_FIELDS = [
+    ('name', Library.name, None),
+    ('id', Library.id, None),
+    ('user', User.name, None),
+    ('book_count', Library.book_count, None),
+]
+LIBRARY = Projection(Library.id, LIBRARY_FIELDS,
+                     joins={'user': Library.user})
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask's JSON, encoded by orjson."""
+
+    # Dates go through Flask's default(), to keep the HTTP date format.
+    options = (orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+               if orjson is not None else 0)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super(OrjsonProvider, self).dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default,
+                            option=self.options).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if self._app.debug:
+            return super(OrjsonProvider, self).response(obj)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default,
+                         option=self.options | orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype)
+
+
+def init_app(app):
+    """Encode the JSON of `app` with orjson, if it is installed."""
+    if orjson is not None and app.config.get('FAST_JSON', True):
+        app.json = OrjsonProvider(app)
+    return app.json
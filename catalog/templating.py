@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Templates and Static Assets.
+
+- Fragment cache: `{% cache 'name', key... %}...{% endcache %}` keeps
+  the rendered markup of a block in memory under the given key, so a
+  page built for one user reuses the parts built for another. Keys
+  should hold the versions of what the block shows (see
+  resource_version()), which makes stale entries unreachable.
+- Templates are compiled once when the app is set up, and the compiled
+  code is kept in TEMPLATE_CACHE_DIR, or in a directory Jinja makes
+  for the app's user, so the next worker skips the compiler.
+- Static files are served under fingerprinted names, e.g.
+  /assets/bookStoreStyle.0123456789ab.css, with a far-future expiry:
+  a changed file gets a new name instead of a stale browser copy.
+"""
+import hashlib
+import os
+
+from flask import abort, g, send_from_directory, url_for
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+import reference
+import versions
+from caching import MemoryCache
+from config import private_directory
+from database import session
+
+# Seconds browsers may keep a fingerprinted asset: a year.
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+fragments = MemoryCache(maxsize=4096, ttl=600)
+
+
+class FragmentCacheExtension(Extension):
+    """The `{% cache key... %}` tag."""
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_cached', [nodes.List(key)]),
+            [], [], body).set_lineno(lineno)
+
+    def _cached(self, key, caller):
+        key = tuple(key)
+        markup = fragments.get(key)
+        if markup is None:
+            markup = caller()
+            fragments.set(key, markup)
+        return markup
+
+
+def resource_version(key):
+    """Return the version of a resource key, e.g. 'library:3'."""
+    # @conditional views have already read the versions of their keys.
+    found = g.get('resource_versions') or {}
+    if key not in found:
+        found = versions.current(session, [key])
+    return found[key][0]
+
+
+class StaticAssets(object):
+    """Fingerprinted names of the files in a static folder."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.names = {}
+        self.files = {}
+        for root, dirs, filenames in os.walk(folder):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()[:12]
+                base, ext = os.path.splitext(name)
+                fingerprinted = '%s.%s%s' % (base, digest, ext)
+                self.names[name] = fingerprinted
+                self.files[fingerprinted] = name
+
+    def url(self, filename):
+        """Return the long-lived URL of a static file."""
+        return url_for('asset', filename=self.names[filename])
+
+    def send(self, filename):
+        """Serve a static file by its fingerprinted name."""
+        name = self.files.get(filename)
+        if name is None:
+            abort(404)
+        response = send_from_directory(self.folder, name,
+                                       max_age=ASSET_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+def init_app(app):
+    """Set up the fragment cache, compiled templates and static assets."""
+    env = app.jinja_env
+    env.add_extension(FragmentCacheExtension)
+    directory = app.config.get('TEMPLATE_CACHE_DIR')
+    if directory is None:
+        # Jinja checks that its directory belongs to this user.
+        env.bytecode_cache = FileSystemBytecodeCache()
+    elif directory:
+        # The cached code is loaded with marshal: no one else may write.
+        env.bytecode_cache = FileSystemBytecodeCache(
+            private_directory(directory))
+
+    assets = StaticAssets(app.static_folder)
+    app.add_url_rule('/assets/<path:filename>', 'asset', assets.send)
+    env.globals.update(static_url=assets.url,
+                       resource_version=resource_version,
+                       genres_version=lambda: reference.genres.version)
+
+    # Compile every template now rather than in the first requests.
+    for name in env.list_templates(extensions=['html']):
+        env.get_template(name)
+    return assets
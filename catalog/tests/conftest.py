@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test Fixtures.
+
+The app runs against a SQLite file and a job queue in a temporary
+directory, with the OAuth providers replaced by a local stub server.
+"""
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# The database module reads its URL when it is first imported, which
+# may be by a test module.
+WORKDIR = tempfile.TemporaryDirectory(prefix='catalog-tests-')
+os.environ.update({
+    'CATALOG_DATABASE_URL': 'sqlite:///' + os.path.join(WORKDIR.name,
+                                                         'library.db'),
+    'CATALOG_JOB_QUEUE': os.path.join(WORKDIR.name, 'jobs.db'),
+    'CATALOG_JOB_WORKERS': '0',
+    'CATALOG_RESPONSE_CACHE': 'null',
+})
+
+GOOGLE_CLIENT_ID = 'client-id.apps.googleusercontent.com'
+GOOGLE_USER_ID = 'google-user-1'
+FACEBOOK_USER_ID = 'facebook-user-1'
+LIBRARY_BOOKS = 5
+
+
+def id_token(claims):
+    """Return an unsigned JWT with `claims`, as oauth2client reads it."""
+    def encode(data):
+        return base64.urlsafe_b64encode(
+            json.dumps(data).encode('utf-8')).decode('ascii').rstrip('=')
+    return '%s.%s.signature' % (encode({'alg': 'none'}), encode(claims))
+
+
+def log_in(client, **values):
+    """Log the test client in, as user 1 unless `values` say otherwise."""
+    user = dict(username='User', email='user@example.com', picture='',
+                user_id=1)
+    user.update(values)
+    with client.session_transaction() as login_session:
+        login_session.update(user)
+
+
+class Stub(object):
+    """The Google and Facebook endpoints the app calls, on localhost."""
+
+    def __init__(self):
+        self.calls = []
+        # Statuses to answer, in order, before the normal answer.
+        self.failures = {}
+        # Seconds to wait before answering.
+        self.delays = {}
+        self.app = self.make_app()
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def reset(self):
+        del self.calls[:]
+        self.failures.clear()
+        self.delays.clear()
+
+    def count(self, path):
+        """Return how many times `path` was requested."""
+        return len([call for call in self.calls if call[0] == path])
+
+    def make_app(self):
+        app = Flask('stub')
+
+        @app.before_request
+        def misbehave():
+            self.calls.append((request.path, request.values.to_dict()))
+            time.sleep(self.delays.get(request.path, 0))
+            failures = self.failures.get(request.path)
+            if failures:
+                return '', failures.pop(0)
+
+        @app.route('/token', methods=['POST'])
+        def token():
+            return jsonify(access_token='google-token', token_type='Bearer',
+                           expires_in=3600,
+                           id_token=id_token({'sub': GOOGLE_USER_ID}))
+
+        @app.route('/oauth2/v1/tokeninfo')
+        def tokeninfo():
+            return jsonify(user_id=GOOGLE_USER_ID, issued_to=GOOGLE_CLIENT_ID)
+
+        @app.route('/oauth2/v1/userinfo')
+        def userinfo():
+            return jsonify(name='Google User', email='google@example.com',
+                           picture='http://example.com/g.png')
+
+        @app.route('/o/oauth2/revoke')
+        def revoke():
+            return ''
+
+        @app.route('/oauth/access_token')
+        def exchange():
+            return jsonify(access_token='facebook-token')
+
+        @app.route('/v2.8/me')
+        def me():
+            return jsonify(name='Facebook User', id=FACEBOOK_USER_ID,
+                           email='facebook@example.com')
+
+        @app.route('/v2.8/me/picture')
+        def picture():
+            return jsonify(data={'url': 'http://example.com/f.png'})
+
+        @app.route('/<facebook_id>/permissions', methods=['DELETE'])
+        def permissions(facebook_id):
+            return jsonify(success=True)
+
+        return app
+
+
+@pytest.fixture(scope='session')
+def stub():
+    stub = Stub()
+    thread = threading.Thread(target=stub.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield stub
+    stub.server.shutdown()
+
+
+def pytest_unconfigure(config):
+    WORKDIR.cleanup()
+
+
+@pytest.fixture(scope='session')
+def app(stub):
+    secrets = {
+        'CATALOG_GOOGLE_CLIENT_SECRETS': {'web': {
+            'client_id': GOOGLE_CLIENT_ID, 'client_secret': 'secret',
+            'auth_uri': stub.url + '/auth',
+            'token_uri': stub.url + '/token'}},
+        'CATALOG_FACEBOOK_CLIENT_SECRETS': {'web': {
+            'app_id': 'app-id', 'app_secret': 'secret'}},
+    }
+    for variable, content in secrets.items():
+        path = os.path.join(WORKDIR.name, variable.lower() + '.json')
+        with open(path, 'w') as f:
+            json.dump(content, f)
+        os.environ[variable] = path
+
+    import database
+    import migrations
+    import providers
+    from application import create_app
+    providers.GOOGLE_API = stub.url
+    providers.GOOGLE_ACCOUNTS = stub.url
+    providers.FACEBOOK_GRAPH = stub.url
+    migrations.upgrade(database.engine)
+    app = create_app()
+    app.config['TESTING'] = True
+    yield app
+    database.engine.dispose()
+
+
+@pytest.fixture
+def client(app, stub):
+    stub.reset()
+    return app.test_client()
+
+
+@pytest.fixture(scope='session')
+def library(app):
+    """A library of LIBRARY_BOOKS books, in a genre of its own."""
+    import reference
+    from database import session
+    from librarydb_setup import Book, Genre, Library, User
+    owner = User(name='Owner', email='owner@example.com')
+    genre = Genre(name='Test Genre')
+    library = Library(name='Test Library', user=owner)
+    session.add_all([genre, library] + [
+        Book(title='Book %d' % i, author='Author', description='',
+             genre=genre, library=library, user=owner)
+        for i in range(LIBRARY_BOOKS)])
+    session.commit()
+    reference.genres.invalidate()
+    library_id = library.id
+    session.remove()
+    return library_id
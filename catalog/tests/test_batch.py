@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""JSON batch writes."""
+import pytest
+
+from conftest import log_in
+
+
+@pytest.fixture
+def owner(client, library):
+    from database import session
+    from librarydb_setup import Library
+    user_id = session.query(Library.user_id).filter_by(id=library).scalar()
+    session.remove()
+    log_in(client, user_id=user_id)
+    return client
+
+
+@pytest.mark.parametrize('title', [None, '', '  '])
+def test_update_rejects_empty_title(owner, library, title):
+    book = owner.get('/libraries/%d/books/JSON?limit=1' % library)
+    book_id = book.get_json()['books'][0]['id']
+    response = owner.post('/books/batch/JSON', json={
+        'update': [{'id': book_id, 'title': title}]})
+    assert response.status_code == 400
+    assert not response.get_json()['results'][0]['ok']
+
+
+def test_large_library_delete_is_rejected(owner, library, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'LARGE_DELETE_THRESHOLD', 1)
+    response = owner.post('/libraries/batch/JSON', json={'delete': [library]})
+    assert response.status_code == 400
+    assert 'too many books' in response.get_json()['results'][0]['errors'][0]
+    assert owner.get('/libraries/%d/books/JSON' % library).status_code == 200
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""The change feed."""
+import pytest
+
+
+@pytest.mark.parametrize('since', ['abc', '-1', '1.5', ''])
+def test_bad_since(client, since):
+    assert client.get('/changes/JSON?since=' + since).status_code == 400
+
+
+@pytest.mark.parametrize('since', ['0', '12'])
+def test_since(client, since):
+    response = client.get('/changes/JSON?since=' + since)
+    assert response.status_code == 200
+    assert 'last_seq' in response.get_json()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Login and logout against the stub OAuth providers."""
+import pytest
+
+import jobs
+import providers
+from conftest import FACEBOOK_USER_ID, log_in
+
+STATE = 'test-state'
+
+
+@pytest.fixture(autouse=True)
+def fresh_providers(monkeypatch):
+    providers._tokeninfo.clear()
+    # Short timeouts, so a slow provider fails the test quickly.
+    monkeypatch.setattr(providers, 'TIMEOUT', (0.5, 0.5))
+    monkeypatch.setattr(jobs.queue, 'retry_delay', 0)
+
+
+def login_state(client):
+    with client.session_transaction() as login_session:
+        login_session['state'] = STATE
+
+
+def run_jobs():
+    """Run the queued jobs that are due; return how many ran."""
+    ran = 0
+    job = jobs.queue.claim()
+    while job is not None:
+        jobs.queue.run(job)
+        ran += 1
+        job = jobs.queue.claim()
+    return ran
+
+
+def gconnect(client):
+    login_state(client)
+    return client.post('/gconnect?state=' + STATE, data='auth-code')
+
+
+def fbconnect(client):
+    login_state(client)
+    return client.post('/fbconnect?state=' + STATE, data='short-token')
+
+
+def test_gconnect(client, stub):
+    response = gconnect(client)
+    assert response.status_code == 200
+    assert b'Welcome, Google User' in response.data
+    with client.session_transaction() as login_session:
+        assert login_session['provider'] == 'google'
+        assert login_session['access_token'] == 'google-token'
+        assert login_session['user_id']
+
+
+def test_gconnect_bad_state(client, stub):
+    login_state(client)
+    response = client.post('/gconnect?state=other', data='auth-code')
+    assert response.status_code == 401
+    assert stub.calls == []
+
+
+def test_gconnect_retries_server_errors(client, stub):
+    stub.failures['/oauth2/v1/userinfo'] = [503, 502]
+    assert gconnect(client).status_code == 200
+    assert stub.count('/oauth2/v1/userinfo') == 3
+
+
+def test_gconnect_gives_up_after_retries(client, stub):
+    stub.failures['/oauth2/v1/tokeninfo'] = [503, 503, 503]
+    assert gconnect(client).status_code == 502
+    assert stub.count('/oauth2/v1/tokeninfo') == 3
+
+
+def test_gconnect_timeout(client, stub):
+    stub.delays['/oauth2/v1/tokeninfo'] = 1
+    assert gconnect(client).status_code == 502
+    with client.session_transaction() as login_session:
+        assert 'user_id' not in login_session
+
+
+def test_fbconnect(client, stub):
+    response = fbconnect(client)
+    assert response.status_code == 200
+    assert b'Welcome, Facebook User' in response.data
+    with client.session_transaction() as login_session:
+        assert login_session['provider'] == 'facebook'
+        assert login_session['access_token'] == 'facebook-token'
+        assert login_session['picture'] == 'http://example.com/f.png'
+
+
+def test_fbconnect_retries_server_errors(client, stub):
+    stub.failures['/oauth/access_token'] = [504]
+    stub.failures['/v2.8/me/picture'] = [503]
+    assert fbconnect(client).status_code == 200
+    assert stub.count('/oauth/access_token') == 2
+    assert stub.count('/v2.8/me/picture') == 2
+
+
+def test_fbconnect_timeout(client, stub):
+    stub.delays['/v2.8/me'] = 1
+    assert fbconnect(client).status_code == 502
+
+
+def test_gdisconnect_revokes_in_background(client, stub):
+    log_in(client, provider='google', access_token='google-token',
+           gplus_id='g')
+    assert client.get('/gdisconnect').status_code == 200
+    assert stub.count('/o/oauth2/revoke') == 0
+    assert run_jobs() == 1
+    assert stub.calls == [('/o/oauth2/revoke', {'token': 'google-token'})]
+
+
+def test_gdisconnect_not_connected(client, stub):
+    assert client.get('/gdisconnect').status_code == 401
+
+
+def test_revoke_retries_server_errors(client, stub):
+    stub.failures['/o/oauth2/revoke'] = [503, 503]
+    log_in(client, provider='google', access_token='google-token',
+           gplus_id='g')
+    client.get('/gdisconnect')
+    assert run_jobs() == 1
+    assert stub.count('/o/oauth2/revoke') == 3
+    assert jobs.queue.backlog()['counts'].get('queued', 0) == 0
+
+
+def test_revoke_timeout_is_retried_as_a_job(client, stub):
+    stub.delays['/o/oauth2/revoke'] = 1
+    log_in(client, provider='google', access_token='google-token',
+           gplus_id='g')
+    client.get('/gdisconnect')
+    jobs.queue.run(jobs.queue.claim())
+    backlog = jobs.queue.backlog()
+    assert backlog['counts']['queued'] == 1
+    assert backlog['recent_failures'][0]['name'] == 'revoke_google_token'
+    stub.delays.clear()
+    assert run_jobs() == 1
+    assert jobs.queue.backlog()['counts'].get('queued', 0) == 0
+
+
+def test_fbdisconnect(client, stub):
+    log_in(client, provider='facebook', access_token='facebook-token',
+           facebook_id=FACEBOOK_USER_ID)
+    assert client.get('/fbdisconnect').status_code == 200
+    assert run_jobs() == 1
+    assert stub.calls == [('/%s/permissions' % FACEBOOK_USER_ID,
+                           {'access_token': 'facebook-token'})]
+
+
+@pytest.mark.parametrize('provider, values, path', [
+    ('google', {'access_token': 'google-token', 'gplus_id': 'g'},
+     '/o/oauth2/revoke'),
+    ('facebook', {'access_token': 'facebook-token',
+                  'facebook_id': FACEBOOK_USER_ID},
+     '/%s/permissions' % FACEBOOK_USER_ID),
+])
+def test_disconnect(client, stub, provider, values, path):
+    log_in(client, provider=provider, **values)
+    response = client.get('/disconnect')
+    assert response.status_code == 302
+    with client.session_transaction() as login_session:
+        assert 'user_id' not in login_session
+    assert run_jobs() == 1
+    assert stub.count(path) == 1
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Keyset pages of the JSON list endpoints."""
+from conftest import LIBRARY_BOOKS
+
+
+def test_next_keeps_fields(client, library):
+    url = '/libraries/%d/books/JSON?fields=title&limit=2' % library
+    titles = []
+    while url:
+        page = client.get(url).get_json()
+        assert all(list(book) == ['title'] for book in page['books'])
+        titles += [book['title'] for book in page['books']]
+        url = page['next']
+        if url:
+            assert 'fields=title' in url
+    assert titles == ['Book %d' % i for i in range(LIBRARY_BOOKS)]
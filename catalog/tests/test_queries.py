@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Query budgets of the main pages, so N+1 queries show up as failures."""
+import pytest
+
+import database
+from conftest import log_in
+
+PAGES = [
+    ('/', 1),
+    ('/libraries/{library}/books', 3),
+    ('/libraries/JSON', 2),
+]
+
+
+@pytest.mark.parametrize('logged_in', [False, True])
+@pytest.mark.parametrize('url, budget', PAGES)
+def test_query_budget(client, library, url, budget, logged_in):
+    url = url.format(library=library)
+    if logged_in:
+        log_in(client)
+    # The first visit fills the reference data and fragment caches.
+    assert client.get(url).status_code == 200
+    with database.assert_max_queries(budget):
+        assert client.get(url).status_code == 200
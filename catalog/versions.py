@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resource Versions.
+
+Every cacheable resource has a key, such as 'libraries', 'library:3',
+'book:12', 'genre:2' or 'books' (the latest books feed). The views
+that change a resource touch() its keys in the same transaction, which
+bumps a counter in the resource_version table. The counters feed the
+HTTP ETags, and the in-process caches subscribe with on_change() to be
+told which keys changed once the transaction commits.
+"""
+import datetime
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from librarydb_setup import ResourceVersion
+
+PENDING_KEYS = 'touched_resource_keys'
+
+_listeners = []
+
+
+def touch(session, *keys):
+    """Bump the version of `keys` as part of the session's transaction."""
+    now = datetime.datetime.utcnow()
+    for key in set(keys):
+        updated = session.query(ResourceVersion).filter_by(key=key).update(
+            {ResourceVersion.version: ResourceVersion.version + 1,
+             ResourceVersion.updated_at: now},
+            synchronize_session=False)
+        if not updated:
+            try:
+                with session.begin_nested():
+                    session.add(ResourceVersion(key=key, version=1,
+                                                updated_at=now))
+            except IntegrityError:
+                # Another transaction created the row first.
+                session.query(ResourceVersion).filter_by(key=key).update(
+                    {ResourceVersion.version: ResourceVersion.version + 1,
+                     ResourceVersion.updated_at: now},
+                    synchronize_session=False)
+    session.info.setdefault(PENDING_KEYS, set()).update(keys)
+
+
+def current(session, keys):
+    """Return {key: (version, updated_at)} for `keys`; missing keys are 0."""
+    found = dict((key, (0, None)) for key in keys)
+    rows = session.query(ResourceVersion).filter(
+        ResourceVersion.key.in_(list(keys)))
+    for row in rows:
+        found[row.key] = (row.version, row.updated_at)
+    return found
+
+
+def on_change(func):
+    """Call `func(keys)` with the keys each committed transaction touched."""
+    _listeners.append(func)
+    return func
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify(session):
+    keys = session.info.pop(PENDING_KEYS, None)
+    if keys:
+        for func in _listeners:
+            func(keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget(session):
+    session.info.pop(PENDING_KEYS, None)
+
+
+def book_keys(book):
+    """Return the keys a change to `book` affects."""
+    return ['books', 'book:%s' % book.id, 'library:%s' % book.library_id,
+            'genre:%s' % book.genre_id]
+
+
+def library_keys(library):
+    """Return the keys a change to `library` affects."""
+    return ['libraries', 'library:%s' % library.id]